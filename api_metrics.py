@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import bisect
+import json
+import re
+import threading
+from pathlib import Path
+
+from typing import Dict, List, Tuple
+
+# Upper bounds (in seconds) of the latency histogram buckets, the last one is everything slower
+latency_buckets = [0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+
+
+def endpoint_name(path: str) -> str:
+    '''Same name for all the calls to one endpoint: events/view/12 and events/view/<uuid> are events/view/:id,
+    jobs/index/sort:id is jobs/index/sort:*'''
+    path = path.strip('/')
+    path = re.sub(r'(?<=/)[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}(?=/|$)', ':id', path)
+    path = re.sub(r'(?<=/)\d+(?=/|$)', ':id', path)
+    # CakePHP named parameters
+    return re.sub(r'(?<=/)(\w+):[^/]+', r'\1:*', path)
+
+
+class EndpointStats():
+
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.total_time = 0.
+        self.max_time = 0.
+        self.histogram = [0] * (len(latency_buckets) + 1)
+
+    def add(self, status_code: int, latency: float, sent: int, received: int):
+        self.requests += 1
+        if status_code >= 400:
+            self.errors += 1
+        self.bytes_sent += sent
+        self.bytes_received += received
+        self.total_time += latency
+        self.max_time = max(self.max_time, latency)
+        self.histogram[bisect.bisect_left(latency_buckets, latency)] += 1
+
+    def to_dict(self) -> dict:
+        return {'requests': self.requests, 'errors': self.errors, 'bytes_sent': self.bytes_sent,
+                'bytes_received': self.bytes_received, 'total_time': self.total_time, 'max_time': self.max_time,
+                'histogram': {f'<={bound}s' if i < len(latency_buckets) else f'>{latency_buckets[-1]}s': count
+                              for i, (bound, count) in enumerate(zip(latency_buckets + [None], self.histogram))}}
+
+
+class ApiMetrics():
+    '''Requests sent by the connectors (see PooledPyMISP), per instance, role of the user and endpoint.'''
+
+    def __init__(self):
+        # (instance, role, method, endpoint) -> stats
+        self.stats: Dict[Tuple[str, str, str, str], EndpointStats] = {}
+        self._lock = threading.Lock()
+
+    def record(self, instance: str, role: str, method: str, path: str, status_code: int, latency: float,
+               sent: int, received: int):
+        key = (instance, role, method, endpoint_name(path))
+        with self._lock:
+            self.stats.setdefault(key, EndpointStats()).add(status_code, latency, sent, received)
+
+    def reset(self):
+        with self._lock:
+            self.stats = {}
+
+    def _merged(self, key_index: List[int]) -> Dict[tuple, EndpointStats]:
+        merged: Dict[tuple, EndpointStats] = {}
+        for key, stats in self.stats.items():
+            total = merged.setdefault(tuple(key[i] for i in key_index), EndpointStats())
+            total.requests += stats.requests
+            total.errors += stats.errors
+            total.bytes_sent += stats.bytes_sent
+            total.bytes_received += stats.bytes_received
+            total.total_time += stats.total_time
+            total.max_time = max(total.max_time, stats.max_time)
+            total.histogram = [a + b for a, b in zip(total.histogram, stats.histogram)]
+        return merged
+
+    def dump(self, metrics_file: Path):
+        metrics_file.parent.mkdir(parents=True, exist_ok=True)
+        with self._lock:
+            to_dump = [{'instance': instance, 'role': role, 'method': method, 'endpoint': endpoint, **stats.to_dict()}
+                       for (instance, role, method, endpoint), stats in sorted(self.stats.items())]
+        with metrics_file.open('w') as f:
+            json.dump(to_dump, f, indent=2)
+
+    def report(self, top: int=15) -> str:
+        '''Endpoints (all the instances together) by total time, and number of requests per instance and role'''
+        with self._lock:
+            per_endpoint = self._merged([2, 3])
+            per_role = self._merged([0, 1])
+        lines = ['API calls per endpoint (requests / errors / total / mean / max / received):']
+        for (method, endpoint), stats in sorted(per_endpoint.items(), key=lambda item: item[1].total_time, reverse=True)[:top]:
+            lines.append(f'    {method:6} {endpoint:50} {stats.requests:6} {stats.errors:4} {stats.total_time:8.1f}s '
+                         f'{stats.total_time / stats.requests:6.3f}s {stats.max_time:6.2f}s {stats.bytes_received / 1024:9.0f}kB')
+        lines.append('API calls per instance and role:')
+        for (instance, role), stats in sorted(per_role.items()):
+            lines.append(f'    {instance:20} {role:12} {stats.requests:6} requests {stats.total_time:8.1f}s')
+        return '\n'.join(lines)
+
+
+# Shared by all the connectors of one run
+api_metrics = ApiMetrics()
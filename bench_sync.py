@@ -0,0 +1,243 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import argparse
+import json
+import time
+import uuid
+from collections import deque
+from pathlib import Path
+
+from concurrent.futures import ThreadPoolExecutor, Future
+from typing import List, Dict, Optional
+
+import urllib3  # type: ignore
+from pymisp import MISPEvent, MISPObject, Distribution
+
+from .setup_sync import MISPInstances, MISPInstance
+from .topology import SyncLink
+from .generic_config import sync_topology, propagation_timeout
+
+urllib3.disable_warnings()
+
+# Same mix as TestSync.create_complex_event
+attribute_distributions = [Distribution.your_organisation_only, Distribution.this_community_only,
+                           Distribution.connected_communities, Distribution.all_communities]
+attribute_tags = ['tlp:red', 'tlp:amber', 'tlp:green', 'tlp:white']
+
+
+def make_event(run_id: str, number: int, attributes: int, objects: int, tags: int) -> MISPEvent:
+    event = MISPEvent()
+    event.info = f'Benchmark {run_id} - event {number}'
+    event.distribution = Distribution.all_communities
+    event.add_tag('tlp:white')
+    for i in range(tags):
+        event.add_tag(f'misp-testing:benchmark-tag="{i}"')
+    for i in range(attributes):
+        attribute = event.add_attribute('ip-dst', f'10.{number % 256}.{i // 256 % 256}.{i % 256}', comment=run_id)
+        attribute.distribution = attribute_distributions[i % len(attribute_distributions)]
+        attribute.add_tag(attribute_tags[i % len(attribute_tags)])
+    for i in range(objects):
+        obj = MISPObject('file')
+        obj.distribution = Distribution.connected_communities
+        obj.add_attribute('filename', f'benchmark-{number}-{i}')
+        obj.add_attribute('md5', uuid.uuid4().hex)
+        obj.attributes[0].distribution = Distribution.your_organisation_only
+        event.add_object(obj)
+    return event
+
+
+def percentile(values: List[float], p: float) -> float:
+    '''Linear interpolation between the closest ranks'''
+    if not values:
+        return 0.
+    values = sorted(values)
+    k = (len(values) - 1) * p / 100
+    f = int(k)
+    c = min(f + 1, len(values) - 1)
+    return values[f] + (values[c] - values[f]) * (k - f)
+
+
+def hops_from(sources: List[str], links: List[SyncLink], mode: str) -> Dict[str, int]:
+    '''Number of hops between the closest source and each reachable instance.
+    push: the source of a link sends to its destination. pull: the source of a link fetches from its destination.'''
+    neighbours: Dict[str, List[str]] = {}
+    for link in links:
+        if mode == 'push':
+            neighbours.setdefault(link.source, []).append(link.dest)
+        else:
+            neighbours.setdefault(link.dest, []).append(link.source)
+    hops = {source: 0 for source in sources}
+    to_visit = deque(sources)
+    while to_visit:
+        node = to_visit.popleft()
+        for neighbour in neighbours.get(node, []):
+            if neighbour not in hops:
+                hops[neighbour] = hops[node] + 1
+                to_visit.append(neighbour)
+    return hops
+
+
+class SyncBenchmark():
+
+    def __init__(self, misp_instances: MISPInstances, sources: List[str], mode: str):
+        self.misp_instances = misp_instances
+        self.instances = misp_instances.by_directory_name
+        self.sources = sources
+        self.mode = mode
+        self.run_id = str(uuid.uuid4())
+        self.hops = hops_from(sources, misp_instances.links, mode)
+        # Event UUID -> publish time, and instance -> event UUID -> (first time visible, attribute count)
+        self.published: Dict[str, float] = {}
+        self.visible: Dict[str, Dict[str, tuple]] = {name: {} for name in self.hops if name not in sources}
+        self.attributes_sent = 0
+
+    def _set_push(self, enabled: bool):
+        for link in self.misp_instances.links:
+            source = self.instances[link.source]
+            server = source.synchronisations[self.instances[link.dest].name]
+            source.site_admin_connector.update_server({'push': enabled or link.push}, server.id)
+
+    def _publish(self, events: List[MISPEvent], rate: float):
+        start = time.time()
+        for i, event in enumerate(events):
+            # Keep the rate, even if one publish is slow
+            delay = start + i / rate - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            source = self.instances[self.sources[i % len(self.sources)]]
+            new_event = source.org_admin_connector.add_event(event)
+            if not isinstance(new_event, MISPEvent):
+                raise Exception(f'{source.name}: unable to add the event: {new_event}')
+            source.org_admin_connector.publish(new_event)
+            self.published[new_event.uuid] = time.time()
+
+    def _poll(self, name: str):
+        instance: MISPInstance = self.instances[name]
+        for event in instance.site_admin_connector.search_index(eventinfo=self.run_id):
+            if event.uuid not in self.visible[name]:
+                self.visible[name][event.uuid] = (time.time(), int(event.attribute_count))
+
+    def _wait_visible(self, names: List[str], number_events: int, timeout: int, poll_interval: float,
+                      publisher: Optional[Future]=None):
+        '''publisher: the publication running meanwhile, no need to wait for the rest of the events if it failed'''
+        deadline = time.time() + timeout
+        with ThreadPoolExecutor(max_workers=len(names)) as executor:
+            while time.time() < deadline:
+                if publisher and publisher.done() and publisher.exception():
+                    return
+                list(executor.map(self._poll, names))
+                if all(len(self.visible[name]) >= number_events for name in names):
+                    return
+                time.sleep(poll_interval)
+        missing = {name: number_events - len(self.visible[name]) for name in names if len(self.visible[name]) < number_events}
+        print(f'Timeout, events missing: {missing}')
+
+    def run(self, events: List[MISPEvent], rate: float, timeout: int, poll_interval: float) -> Dict[str, dict]:
+        self.attributes_sent = sum(len(e.attributes) + sum(len(o.attributes) for o in e.objects) for e in events)
+        downstream = [name for name in self.visible]
+        # Instance -> time the sync started for that instance
+        sync_start: Dict[str, float] = {}
+        if self.mode == 'push':
+            self._set_push(True)
+            try:
+                publish_start = time.time()
+                with ThreadPoolExecutor(max_workers=1) as executor:
+                    publisher = executor.submit(self._publish, events, rate)
+                    self._wait_visible(downstream, len(events), timeout, poll_interval, publisher)
+                    # Raises the exception of the publication, if any: no results for events never published
+                    publisher.result()
+            finally:
+                self._set_push(False)
+            sync_start = {name: publish_start for name in downstream}
+        else:
+            self._publish(events, rate)
+            # Hop by hop: pull from the instances that already have the events
+            for hop in range(1, max(self.hops.values()) + 1):
+                names = [name for name in downstream if self.hops[name] == hop]
+                for name in names:
+                    instance = self.instances[name]
+                    sync_start[name] = time.time()
+                    for link in self.misp_instances.links:
+                        if link.source == name and self.hops.get(link.dest) == hop - 1:
+                            dest = self.instances[link.dest]
+                            instance.site_admin_connector.server_pull(instance.synchronisations[dest.name])
+                self._wait_visible(names, len(events), timeout, poll_interval)
+        return self.report(sync_start)
+
+    def report(self, sync_start: Dict[str, float]) -> Dict[str, dict]:
+        results: Dict[str, dict] = {}
+        for hop in sorted(set(self.hops[name] for name in self.visible)):
+            names = [name for name in self.visible if self.hops[name] == hop]
+            latencies = [seen - self.published[event_uuid]
+                         for name in names for event_uuid, (seen, _) in self.visible[name].items()
+                         if event_uuid in self.published]
+            per_instance = {}
+            for name in names:
+                if not self.visible[name]:
+                    per_instance[name] = {'events': 0}
+                    continue
+                duration = max(seen for seen, _ in self.visible[name].values()) - sync_start[name]
+                attributes = sum(count for _, count in self.visible[name].values())
+                per_instance[name] = {'events': len(self.visible[name]), 'attributes': attributes,
+                                      'events_per_second': len(self.visible[name]) / duration if duration else None,
+                                      'attributes_per_second': attributes / duration if duration else None}
+            results[str(hop)] = {
+                'instances': per_instance,
+                'time_to_visibility': {'p50': percentile(latencies, 50), 'p95': percentile(latencies, 95),
+                                       'p99': percentile(latencies, 99), 'max': max(latencies, default=0.)}
+            }
+        return results
+
+    def cleanup(self):
+        def delete_all(instance: MISPInstance):
+            for event_uuid in self.published:
+                instance.site_admin_connector.delete_event(event_uuid)
+        with ThreadPoolExecutor(max_workers=len(self.instances)) as executor:
+            list(executor.map(delete_all, self.instances.values()))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measure the sync throughput and the propagation latency between the MISP instances.')
+    parser.add_argument('--misps', type=Path, default=Path(__file__).parent / 'misps', help='Directory of the instances.')
+    parser.add_argument('--topology', default=sync_topology, help='star, full_mesh, chain, ring or tree.')
+    parser.add_argument('--instances', type=int, help='Only use the first N client instances.')
+    parser.add_argument('--edges', type=Path, help='JSON file with the list of sync links, overwrites --topology.')
+    parser.add_argument('--mode', choices=['push', 'pull'], default='push')
+    parser.add_argument('--sources', default='', help='Comma separated instances publishing the events (default: the first client).')
+    parser.add_argument('--events', type=int, default=20, help='Number of events to publish.')
+    parser.add_argument('--attributes', type=int, default=4, help='Attributes per event.')
+    parser.add_argument('--objects', type=int, default=1, help='File objects per event.')
+    parser.add_argument('--tags', type=int, default=0, help='Extra tags per event.')
+    parser.add_argument('--rate', type=float, default=1., help='Events published per second (all sources together).')
+    parser.add_argument('--timeout', type=int, default=propagation_timeout, help='Max time to wait for the events on each hop.')
+    parser.add_argument('--poll-interval', type=float, default=0.5)
+    parser.add_argument('--keep', action='store_true', help='Do not delete the events at the end.')
+    parser.add_argument('--output', type=Path, default=Path('bench_results.json'))
+    args = parser.parse_args()
+
+    misp_instances = MISPInstances(str(args.misps), topology=args.topology, number_instances=args.instances,
+                                   edges_file=args.edges)
+    misp_instances.wait_for_workers()
+    sources = args.sources.split(',') if args.sources else [misp_instances.instances[0].directory_name]
+    benchmark = SyncBenchmark(misp_instances, sources, args.mode)
+    events = [make_event(benchmark.run_id, i, args.attributes, args.objects, args.tags) for i in range(args.events)]
+    try:
+        hops = benchmark.run(events, args.rate, args.timeout, args.poll_interval)
+    finally:
+        if not args.keep:
+            benchmark.cleanup()
+
+    results = {
+        'run_id': benchmark.run_id,
+        'date': time.time(),
+        'misp_version': misp_instances.central_node.site_admin_connector.misp_instance_version.get('version'),
+        'parameters': {key: str(value) if isinstance(value, Path) else value for key, value in vars(args).items()},
+        'sources': sources,
+        'events_published': len(benchmark.published),
+        'attributes_published': benchmark.attributes_sent,
+        'hops': hops,
+    }
+    with args.output.open('w') as f:
+        json.dump(results, f, indent=2)
+    print(json.dumps(results['hops'], indent=2))
@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import io
+import re
+import shlex
+from pathlib import Path
+from subprocess import Popen, PIPE, STDOUT
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+import docker  # type: ignore
+from docker.errors import ImageNotFound, NotFound  # type: ignore
+from docker.models.containers import Container  # type: ignore
+from docker.models.networks import Network  # type: ignore
+
+from generic_config import docker_compose_command
+
+
+def run_command(command: str, cwd: Optional[Path]=None, log_file: Optional[Path]=None, capture: bool=False) -> str:
+    # NOTE: never chdir, multiple instances can be initialized at the same time.
+    stdout = PIPE if capture else None
+    if log_file:
+        with log_file.open('a') as log:
+            log.write(f'$ {command}\n')
+            log.flush()
+            p = Popen(shlex.split(command), cwd=cwd, stdout=stdout or log, stderr=log if capture else STDOUT)
+            output = p.communicate()[0]
+    else:
+        p = Popen(shlex.split(command), cwd=cwd, stdout=stdout)
+        output = p.communicate()[0]
+    if p.returncode != 0:
+        raise Exception(f'"{command}" failed (exit code {p.returncode})')
+    return output.decode().strip() if output else ''
+
+
+def run_parallel(fn: Callable[[Any], float], items: Iterable[Any], workers: int, done: Optional[str]=None,
+                 on_error: Optional[Callable[[Any], None]]=None) -> Tuple[Dict[str, float], Dict[str, str]]:
+    '''Call fn on all the items (instances, project directories: anything with a name), at most *workers* at the same time.
+    fn returns the time it took, in seconds. A failing item doesn't stop the other ones.
+    done: if set, each item is printed as soon as it is done (<name> <done> (<duration>)) or failed.
+    on_error: called in the exception handler of a failing item (traceback.print_exc works there).
+    Returns (name -> duration, name -> error).'''
+    durations: Dict[str, float] = {}
+    failures: Dict[str, str] = {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(fn, item): item for item in items}
+        for future in as_completed(futures):
+            item = futures[future]
+            try:
+                durations[item.name] = future.result()
+                if done:
+                    print(f'{item.name} {done} ({durations[item.name]:.0f}s).')
+            except Exception as e:
+                failures[item.name] = str(e)
+                if done:
+                    print(f'{item.name} failed: {e}')
+                if on_error:
+                    on_error(item)
+    return durations, failures
+
+
+def print_summary(names: Iterable[str], durations: Dict[str, float], failures: Dict[str, str],
+                  details: Callable[[str], str]=lambda name: '', title: str='Summary'):
+    '''One line per name, with the result of run_parallel. details: appended to the line (log file, ...)'''
+    print(f'{title}:')
+    for name in names:
+        if name in failures:
+            status = f'FAILED - {failures[name]}'
+        else:
+            status = f'OK ({durations[name]:.0f}s)'
+        print(f'    {name}: {status}{details(name)}')
+
+
+def compose_project_name(project_dir: Path) -> str:
+    '''Same as the default project name of docker-compose (name of the directory)'''
+    return re.sub(r'[^-_a-z0-9]', '', project_dir.resolve().name.lower())
+
+
+# Set on all the services of the instances (see MISPDocker._prepare_docker_compose): the containers are found the same way
+# when each instance is a compose project and when all of them are in one project (see federation.py)
+instance_label = 'misp-testing.instance'
+service_label = 'misp-testing.service'
+
+
+class DockerControl():
+    '''One connection to the docker daemon, shared by all the instances (and threads).
+    Only docker-compose itself (up, stop, build) is still a separate process, always started in the project directory,
+    never with a chdir.'''
+
+    def __init__(self):
+        self.client = docker.from_env()
+
+    def compose(self, project_dir: Path, arguments: str, log_file: Optional[Path]=None, capture: bool=False) -> str:
+        return run_command(f'{docker_compose_command} {arguments}', cwd=project_dir, log_file=log_file, capture=capture)
+
+    def container(self, project_dir: Path, service: str, stopped: bool=False) -> Container:
+        '''Container of *service*, *stopped*: also the containers that aren't running'''
+        containers = self.client.containers.list(all=stopped, filters={'label': [f'{instance_label}={project_dir.name}',
+                                                                                 f'{service_label}={service}']})
+        if not containers:
+            # Projects without the labels (nginx proxy, shared backends)
+            containers = self.client.containers.list(all=stopped,
+                                                     filters={'label': [f'com.docker.compose.project={compose_project_name(project_dir)}',
+                                                                        f'com.docker.compose.service={service}']})
+        if not containers:
+            raise Exception(f'{project_dir.name}: no {"" if stopped else "running "}container for {service}')
+        return containers[0]
+
+    def copy_volume(self, source: str, target: str, image: str, labels: Optional[Dict[str, str]]=None):
+        '''Replace the content of the volume *target* by the one of *source*, in a helper container running *image*
+        (the image of the service using the volume, it is already there). The target is created if needed.'''
+        if not self.volume_exists(target):
+            self.client.volumes.create(target, labels=labels)
+        self.client.containers.run(image, entrypoint=['sh', '-c', 'find /target -mindepth 1 -delete && cp -a /source/. /target/'],
+                                   user='root', remove=True,
+                                   volumes={source: {'bind': '/source', 'mode': 'ro'}, target: {'bind': '/target', 'mode': 'rw'}})
+
+    def remove_volumes(self, prefix: str, suffix: str=''):
+        # The name filter of the API matches anywhere in the name
+        for volume in self.client.volumes.list(filters={'name': prefix}):
+            if volume.name.startswith(prefix) and volume.name.endswith(suffix):
+                volume.remove()
+
+    def volume_exists(self, name: str) -> bool:
+        try:
+            self.client.volumes.get(name)
+            return True
+        except NotFound:
+            return False
+
+    def project_containers(self, project_dir: Path) -> List[Container]:
+        '''All the containers (running or not) of the compose project in *project_dir*'''
+        return self.client.containers.list(all=True, filters={'label': f'com.docker.compose.project={compose_project_name(project_dir)}'})
+
+    def is_running(self, project_dir: Path, service: str) -> bool:
+        try:
+            self.container(project_dir, service)
+            return True
+        except Exception:
+            return False
+
+    def exec(self, container: Container, command: List[str], user: str='root') -> Tuple[int, str]:
+        '''Run *command* in the container, returns the exit code and the output (stdout and stderr)'''
+        exit_code, output = container.exec_run(command, user=user)
+        return exit_code, output.decode(errors='replace') if output else ''
+
+    def service_ips(self, network: str, service: str) -> Dict[str, str]:
+        '''Instance -> IP on *network* of the container of *service*, for all the instances in one request'''
+        containers = self.client.api.containers(filters={'network': network, 'label': f'{service_label}={service}'})
+        ips = {}
+        for container in containers:
+            instance = container['Labels'].get(instance_label)
+            ip = container['NetworkSettings']['Networks'].get(network, {}).get('IPAddress')
+            if instance and ip:
+                ips[instance] = ip
+        return ips
+
+    def networks(self, name: str) -> List[Network]:
+        # The name filter of the API also matches the networks with a longer name
+        return [network for network in self.client.networks.list(names=[name]) if network.name == name]
+
+    def create_network(self, name: str):
+        '''Internal network, does nothing if it already exists'''
+        if not self.networks(name):
+            self.client.networks.create(name, internal=True, attachable=True)
+
+    def remove_network(self, name: str):
+        for network in self.networks(name):
+            network.remove()
+
+    def image_exists(self, name: str) -> bool:
+        try:
+            self.client.images.get(name)
+            return True
+        except ImageNotFound:
+            return False
+
+    def build_image(self, dockerfile: str, tag: str):
+        '''Build an image from a Dockerfile without context (only FROM and RUN)'''
+        image, logs = self.client.images.build(fileobj=io.BytesIO(dockerfile.encode()), tag=tag, rm=True)
+        for entry in logs:
+            if 'stream' in entry:
+                print(entry['stream'], end='')
+
+    def tag_image(self, source: str, target: str):
+        repository, tag = target.rsplit(':', 1)
+        self.client.images.get(source).tag(repository, tag)
+
+    def container_by_name(self, name: str) -> Container:
+        try:
+            return self.client.containers.get(name)
+        except NotFound:
+            raise Exception(f'No container called {name}')
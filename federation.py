@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import json
+from pathlib import Path
+
+from typing import Dict, List, Optional
+import yaml
+
+from docker_control import DockerControl, compose_project_name
+
+
+class Federation():
+    '''One compose project with the services of all the instances and of the nginx proxy (misps/federation),
+    generated from the compose files of the instances. Starting or stopping everything is one docker-compose call.
+    The services are called <instance>_<service>, each instance has its own network where its services have
+    their original names (db, redis, ...), the volumes keep the names they have in the project of the instance.'''
+
+    def __init__(self, root_dir: Path):
+        self.project_dir = root_dir / 'federation'
+        self.services_file = self.project_dir / 'services.json'
+
+    @property
+    def enabled(self) -> bool:
+        return (self.project_dir / 'docker-compose.yml').exists()
+
+    @property
+    def services(self) -> Dict[str, List[str]]:
+        '''Instance (or nginx-proxy) -> its services in the federation project'''
+        if not self.services_file.exists():
+            return {}
+        with self.services_file.open() as f:
+            return json.load(f)
+
+    @staticmethod
+    def _rewrite_volume(volume: str, source_dir: Path, volumes: Dict[str, dict]) -> str:
+        parts = volume.split(':')
+        if parts[0].startswith('.'):
+            # Bind mount, relative to the directory of the instance
+            parts[0] = str((source_dir / parts[0]).resolve())
+        elif parts[0].startswith('/'):
+            pass
+        elif len(parts) > 1:
+            # Named volume, same volume as in the project of the instance
+            key = f'{source_dir.name}_{parts[0]}'
+            volumes[key] = {'name': f'{compose_project_name(source_dir)}_{parts[0]}'}
+            parts[0] = key
+        return ':'.join(parts)
+
+    def _add_project(self, source_dir: Path, docker_content: dict, all_services: Dict[str, dict],
+                     networks: Dict[str, dict], volumes: Dict[str, dict]) -> List[str]:
+        prefix = source_dir.name
+        network = f'{prefix}_default'
+        networks[network] = {}
+        names = []
+        for service, config in docker_content['services'].items():
+            config = dict(config)
+            name = f'{prefix}_{service}'
+            if 'volumes' in config:
+                config['volumes'] = [self._rewrite_volume(volume, source_dir, volumes) if isinstance(volume, str) else volume
+                                     for volume in config['volumes']]
+            if 'depends_on' in config:
+                config['depends_on'] = [f'{prefix}_{dependency}' for dependency in config['depends_on']]
+            if 'build' in config:
+                raise Exception(f'{name}: the services of the federation cannot be built, they use the images of the instances')
+            if 'env_file' in config:
+                files = config['env_file'] if isinstance(config['env_file'], list) else [config['env_file']]
+                config['env_file'] = [str((source_dir / path).resolve()) for path in files]
+            # The default network of the instance, the others (the internal network) are shared
+            service_networks = config.get('networks', ['default'])
+            if isinstance(service_networks, dict):
+                service_networks = list(service_networks)
+            config['networks'] = {(network if n == 'default' else n): ({'aliases': [service]} if n == 'default' else {})
+                                  for n in service_networks}
+            for n in service_networks:
+                if n != 'default':
+                    networks[n] = docker_content['networks'][n]
+            all_services[name] = config
+            names.append(name)
+        return names
+
+    def generate(self, instance_dirs: List[Path], nginx_dir: Optional[Path]=None):
+        '''Write the federation project from the compose files of the instances (already prepared by MISPDocker)'''
+        self.project_dir.mkdir(exist_ok=True)
+        all_services: Dict[str, dict] = {}
+        networks: Dict[str, dict] = {}
+        volumes: Dict[str, dict] = {}
+        services: Dict[str, List[str]] = {}
+        for source_dir in instance_dirs + ([nginx_dir] if nginx_dir else []):
+            with (source_dir / 'docker-compose.yml').open() as f:
+                docker_content = yaml.safe_load(f.read())
+            services[source_dir.name] = self._add_project(source_dir, docker_content, all_services, networks, volumes)
+
+        # Ports on the host can't collide, whatever the allocation of the instances is
+        published: Dict[str, str] = {}
+        for name, config in all_services.items():
+            for port in config.get('ports', []):
+                if ':' not in str(port):
+                    # Random port on the host
+                    continue
+                host_port = str(port).rsplit(':', 1)[0]
+                if host_port in published:
+                    raise Exception(f'Port {host_port} used by {published[host_port]} and {name}')
+                published[host_port] = name
+
+        # version 3.4: name of the volumes
+        docker_content = {'version': '3.4', 'services': all_services, 'networks': networks, 'volumes': volumes}
+        with (self.project_dir / 'docker-compose.yml').open('w') as f:
+            f.write(yaml.dump(docker_content, default_flow_style=False))
+        with self.services_file.open('w') as f:
+            json.dump(services, f, indent=2)
+
+    def compose(self, docker_control: DockerControl, arguments: str, log_file: Optional[Path]=None) -> str:
+        return docker_control.compose(self.project_dir, arguments, log_file=log_file)
+
+
+def instance_compose(docker_control: DockerControl, misp_dir: Path, command: str, log_file: Optional[Path]=None) -> str:
+    '''docker-compose *command* (stop, start, ...) on the services of one instance, in the federation project if
+    the instance is part of it, in its own project otherwise.'''
+    federation = Federation(misp_dir.parent)
+    if federation.enabled and misp_dir.name in federation.services:
+        return federation.compose(docker_control, f'{command} {" ".join(federation.services[misp_dir.name])}', log_file)
+    return docker_control.compose(misp_dir, command, log_file=log_file)
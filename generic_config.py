@@ -5,12 +5,52 @@ internal_network_name = 'custom_misp_testing_environment'
 
 # NOTE: There will be an extra instances (the central node), where all the client synchronize with (push)
 number_instances = 3
+# The client instances are named <prefix_client_node><id>, the id zero padded to that width (1: misp-1, ..., misp-10).
+# Doesn't depend on the number of instances, so that the names stay the same between runs: changing it creates
+# new instances (new directories, hostnames and containers) next to the old ones.
+instance_number_width = 1
 
 url_scheme = 'http'
 central_node_name = 'misp-central'
 prefix_client_node = 'misp-'
 hostname_suffix = '.local'
 
+docker_misp_repo_url = 'https://github.com/coolacid/docker-misp.git'
+# The docker-misp images are built once and tagged <repository>:<service>-<docker-misp commit>-<hash of the build inputs>
+image_repository = 'misp-testing/docker-misp'
+
+# The containers are controlled through the docker API (the user needs access to the docker socket),
+# only docker-compose itself is called as a command
+docker_compose_command = 'sudo docker-compose'
+
+# Ports on the host: http on ports_start + 2 * instance id, https on the next one (central node: id 0)
+ports_start = 20000
+
+# Number of instances brought up at the same time by init_misps.py (1 means one after the other)
+bringup_workers = 4
+# Resources needed by one instance (all its containers), an instance is only brought up when the host has them.
+# 0 memory: no limit, only bringup_workers
+instance_memory_mb = 1536
+instance_cpus = 0.5
+# Memory left to the host
+reserved_memory_mb = 1024
+# Max time (in seconds) an instance waits for resources before failing
+admission_timeout = 1800
+# One MySQL server (a database per instance) and one redis (a logical database per instance) for all the instances,
+# instead of one of each per instance
+shared_backends = False
+shared_backends_name = 'shared-backends'
+# With the shared backends: memory needed by one instance (only its misp container), and memory of the shared
+# MySQL server and redis, reserved once for all the instances
+shared_instance_memory_mb = 512
+shared_backends_memory_mb = 2048
+# Packages needed by misp-refresh, installed in the misp image when it is built
+refresh_packages = ['jq', 'curl', 'dialog']
+# Number of instances refreshed at the same time by refresh_misps.py
+refresh_workers = 8
+# Number of instances stopped or removed at the same time by stop_misps.py
+teardown_workers = 8
+
 # #### Sync config
 
 secure_connection = False
@@ -19,3 +59,15 @@ client_node_org_name_prefix = 'Node '
 admin_email_name = 'siteadmin'
 orgadmin_email_name = 'orgadmin'
 user_email_name = 'user'
+# Sync links created by setup_sync.py: star, full_mesh, chain, ring or tree (see topology.py)
+sync_topology = 'full_mesh'
+sync_tree_fanout = 2
+# Max number of concurrent API requests sent to one instance while setting up the sync
+max_requests_per_instance = 4
+
+# Max time (in seconds) to wait for an event to be visible on an other instance after a sync
+propagation_timeout = 120
+# Print the hop by hop timeline (publish, sync jobs, visibility) of the events in the tests
+trace_propagation = False
+# Max time (in seconds) to wait for the background workers of all the instances to be up
+workers_timeout = 300
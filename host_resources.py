@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import threading
+import time
+
+from typing import Dict, Tuple
+
+
+def meminfo() -> Dict[str, int]:
+    '''/proc/meminfo, in MB'''
+    info = {}
+    with open('/proc/meminfo') as f:
+        for line in f:
+            key, value = line.split(':', 1)
+            info[key] = int(value.split()[0]) // 1024
+    return info
+
+
+def _cpu_times() -> Tuple[int, int]:
+    '''(idle, total) jiffies of all the CPUs since the boot'''
+    with open('/proc/stat') as f:
+        values = [int(value) for value in f.readline().split()[1:]]
+    # idle + iowait
+    return values[3] + values[4], sum(values)
+
+
+def idle_cpus(interval: float=1.) -> float:
+    '''Number of CPUs idle during *interval* seconds'''
+    idle_start, total_start = _cpu_times()
+    time.sleep(interval)
+    idle_end, total_end = _cpu_times()
+    if total_end == total_start:
+        return float(os.cpu_count() or 1)
+    return (idle_end - idle_start) / (total_end - total_start) * (os.cpu_count() or 1)
+
+
+class AdmissionControl():
+    '''Starts the bring up of an instance only when the host has the memory and the CPU for it.
+    The memory of an instance being brought up is reserved until it is done: before that, its containers
+    don't use all their memory yet, and MemAvailable is too optimistic.'''
+
+    def __init__(self, memory_mb: int, cpus: float, reserved_memory_mb: int, timeout: int):
+        self.memory_mb = memory_mb
+        self.cpus = cpus
+        self.reserved_memory_mb = reserved_memory_mb
+        self.timeout = timeout
+        self.in_progress = 0
+        # Number of acquire calls that succeeded, see acquire
+        self.admitted = 0
+        self._lock = threading.Lock()
+        self.start_available_mb = meminfo()['MemAvailable']
+        self.started = 0
+
+    def _free_memory(self) -> int:
+        return meminfo()['MemAvailable'] - self.reserved_memory_mb - self.in_progress * self.memory_mb
+
+    def acquire(self, name: str):
+        '''Wait until the host can take one more instance, release must be called once it is up'''
+        deadline = time.time() + self.timeout
+        while True:
+            # The CPU sample takes a second, it is taken outside the lock: the other threads and release() don't wait
+            # for it. The instances admitted meanwhile by other threads aren't in the sample, their CPUs are deducted.
+            admitted = self.admitted
+            sampled_cpus = idle_cpus()
+            with self._lock:
+                free_mb = self._free_memory()
+                cpus = sampled_cpus - (self.admitted - admitted) * self.cpus
+                if free_mb >= self.memory_mb and cpus >= self.cpus:
+                    self.in_progress += 1
+                    self.admitted += 1
+                    break
+                if free_mb < self.memory_mb and not self.in_progress:
+                    # Nothing will free memory, waiting is useless (the CPU is worth waiting for)
+                    raise Exception(f'{name}: not enough resources on the host ({free_mb}MB free, {cpus:.1f} CPUs idle, '
+                                    f'{self.memory_mb}MB and {self.cpus} CPUs needed per instance)')
+            if time.time() > deadline:
+                raise Exception(f'{name}: still not enough resources on the host after {self.timeout}s')
+            time.sleep(2)
+
+    def acquire_all(self, count: int, name: str):
+        '''*count* instances started at the same time (see init_misps.py --federation): no waiting, fails at once
+        if the host can't take all of them. release must be called once for each of them.'''
+        with self._lock:
+            free_mb = self._free_memory()
+            if free_mb < count * self.memory_mb:
+                raise Exception(f'{name}: not enough memory on the host for {count} instances started together '
+                                f'({free_mb}MB free, {count * self.memory_mb}MB needed)')
+            self.in_progress += count
+            self.admitted += count
+
+    def release(self):
+        with self._lock:
+            self.in_progress -= 1
+            self.started += 1
+
+    def capacity(self, running: int) -> str:
+        '''Largest number of instances the host can run, from the budget and from what was measured during this run'''
+        info = meminfo()
+        usable_mb = info['MemTotal'] - self.reserved_memory_mb
+        report = f'Host capacity: {usable_mb // self.memory_mb} instances with a budget of {self.memory_mb}MB per instance'
+        used_mb = self.start_available_mb - info['MemAvailable']
+        if self.started and used_mb > 0:
+            measured_mb = used_mb / self.started
+            more = max(info['MemAvailable'] - self.reserved_memory_mb, 0) / measured_mb
+            report += (f', about {running + int(more)} instances with the {measured_mb:.0f}MB per instance '
+                       f'measured during this run ({running} running)')
+        return report
@@ -1,30 +1,179 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import argparse
+import hashlib
 import json
 from pathlib import Path
 import git
-from subprocess import Popen, PIPE
 import shlex
-import os
 import random
 import string
+import time
+import traceback
+import threading
+import uuid
 import yaml
 
-from generic_config import (internal_network_name, number_instances, central_node_name,
+from typing import Dict, List, Optional, Tuple
+
+from generic_config import (internal_network_name, number_instances, instance_number_width, central_node_name,
                             hostname_suffix, prefix_client_node,
                             admin_email_name, orgadmin_email_name, user_email_name,
-                            central_node_org_name, client_node_org_name_prefix, url_scheme)
+                            central_node_org_name, client_node_org_name_prefix, url_scheme,
+                            bringup_workers, docker_misp_repo_url, image_repository, refresh_packages,
+                            instance_memory_mb, instance_cpus, reserved_memory_mb, admission_timeout,
+                            shared_backends, shared_backends_name, ports_start,
+                            shared_instance_memory_mb, shared_backends_memory_mb)
+from docker_control import (DockerControl, compose_project_name, instance_label, service_label, run_parallel,
+                            print_summary)
+from timing import tracer
+from host_resources import AdmissionControl
+from federation import Federation
+
+# Started by start_nginx.py, part of the federation project with --federation
+nginx_root = Path('nginx-proxy')
+
+
+def checkout_worktree(mirror: git.Repo, path: Path, commit: str) -> git.Repo:
+    '''Lightweight checkout of *commit*, sharing the objects of the local mirror.'''
+    if not path.exists():
+        mirror.git.worktree('add', '--detach', str(path.resolve()), commit)
+        return git.Repo(path)
+    repo = git.Repo(path)
+    # Reset the file modified by MISPDocker._prepare_docker_compose
+    repo.git.checkout('docker-compose.yml')
+    try:
+        repo.git.checkout('--detach', commit)
+    except git.GitCommandError:
+        # Full clone made before the mirror existed, the commit may be missing
+        repo.git.fetch(str(Path(mirror.git_dir).resolve()))
+        repo.git.checkout('--detach', commit)
+    return repo
+
+
+# Layer added on top of the misp image, so the refresh doesn't need to install anything
+tooling_dockerfile = '''FROM {base_image}
+RUN apt-get update && apt-get install -y --no-install-recommends {packages} && rm -rf /var/lib/apt/lists/*
+'''
+
+
+def hash_build_inputs(build_dir: Path, contexts: List[str], extra: str='') -> str:
+    '''Hash of everything that ends up in the images: the build compose file, the .env, the build contexts
+    and *extra* (the tooling layer)'''
+    to_hash = [build_dir / 'build-docker-compose.yml', build_dir / '.env']
+    for context in contexts:
+        to_hash += [path for path in (build_dir / context).rglob('*') if path.is_file()]
+    h = hashlib.sha256()
+    for path in sorted(to_hash):
+        if not path.exists():
+            continue
+        h.update(str(path.relative_to(build_dir)).encode())
+        h.update(path.read_bytes())
+    h.update(extra.encode())
+    return h.hexdigest()
+
+
+def known_instances(misp_instances_dir: Path) -> List[Path]:
+    '''Directories of all the instances ever initialized in *misp_instances_dir* (see MISPDockerManager.record_instances)'''
+    instances_file = misp_instances_dir / 'instances.json'
+    if not instances_file.exists():
+        return []
+    with instances_file.open() as f:
+        return [misp_instances_dir / name for name in json.load(f)]
+
+
+def random_password() -> str:
+    return ''.join(random.choices(string.ascii_letters + string.digits, k=32))
+
+
+class SharedBackends():
+    '''Compose project with the MySQL server and the redis used by all the instances (see shared_backends).
+    Same images as the db and redis services of docker-misp, the services have the same names,
+    so snapshot_misps.py and stop_misps.py handle it as an instance.'''
+
+    db_host = 'misp-shared-db'
+    redis_host = 'misp-shared-redis'
+
+    def __init__(self, root_dir: Path, build_dir: Path, number_instances: int, docker_control: DockerControl):
+        self.project_dir = root_dir / shared_backends_name
+        self.project_dir.mkdir(exist_ok=True)
+        self.docker_control = docker_control
+        self.config_file = self.project_dir / 'config.json'
+        if self.config_file.exists():
+            with self.config_file.open() as f:
+                self.config = json.load(f)
+        else:
+            self.config = {'root_password': random_password()}
+            with self.config_file.open('w') as f:
+                json.dump(self.config, f, indent=2)
+
+        with (build_dir / 'docker-compose.yml').open() as f:
+            docker_misp = yaml.safe_load(f.read())['services']
+        db = {'image': docker_misp['db']['image'], 'restart': 'always',
+              'environment': [f'MYSQL_ROOT_PASSWORD={self.config["root_password"]}'],
+              'volumes': ['mysql_data:/var/lib/mysql'], 'networks': {'misp-test-sync': {'aliases': [self.db_host]}}}
+        for key in ('command', 'cap_add'):
+            if key in docker_misp['db']:
+                db[key] = docker_misp['db'][key]
+        redis = {'image': docker_misp['redis']['image'], 'restart': 'always',
+                 # One logical database per instance (the default is 16)
+                 'command': f'redis-server --databases {max(16, number_instances + 1)}',
+                 'volumes': ['redis_data:/data'], 'networks': {'misp-test-sync': {'aliases': [self.redis_host]}}}
+        docker_content = {'version': '3', 'services': {'db': db, 'redis': redis},
+                          'volumes': {'mysql_data': None, 'redis_data': None},
+                          'networks': {'misp-test-sync': {'external': {'name': internal_network_name}}}}
+        with (self.project_dir / 'docker-compose.yml').open('w') as f:
+            f.write(yaml.dump(docker_content, default_flow_style=False))
+        self._running = False
+        self._lock = threading.Lock()
+
+    def run(self, timeout: int=300):
+        '''Start the backends (once) and wait until MySQL accepts connections'''
+        with self._lock:
+            if self._running:
+                return
+            with tracer.span('compose up', shared_backends_name):
+                self.docker_control.compose(self.project_dir, 'up -d')
+            db = self.docker_control.container(self.project_dir, 'db')
+            deadline = time.time() + timeout
+            while self._mysql(db, 'SELECT 1')[0] != 0:
+                if time.time() > deadline:
+                    raise Exception(f'{shared_backends_name}: MySQL not ready after {timeout}s')
+                time.sleep(2)
+            self._running = True
+
+    def _mysql(self, container, query: str) -> Tuple[int, str]:
+        return self.docker_control.exec(container, ['mysql', '-uroot', f'-p{self.config["root_password"]}', '-e', query])
+
+    def create_database(self, name: str, user: str, password: str):
+        '''Database and user of one instance, does nothing if they already exist'''
+        self.run()
+        db = self.docker_control.container(self.project_dir, 'db')
+        exit_code, output = self._mysql(db, f"CREATE DATABASE IF NOT EXISTS `{name}`; "
+                                            f"CREATE USER IF NOT EXISTS '{user}'@'%' IDENTIFIED BY '{password}'; "
+                                            f"GRANT ALL PRIVILEGES ON `{name}`.* TO '{user}'@'%';")
+        if exit_code != 0:
+            raise Exception(f'Unable to create the database {name}: {output}')
 
 
 class MISPDocker():
 
-    def __init__(self, root_dir: Path, instance_id: int, instances_number_width: int, url_scheme: str):
+    def __init__(self, root_dir: Path, instance_id: int, instances_number_width: int, url_scheme: str,
+                 mirror: git.Repo, commit: str, images: Dict[str, str], docker_control: DockerControl,
+                 shared_backends: Optional[SharedBackends]=None):
         self.instance_id = instance_id
+        self.docker_control = docker_control
+        self.shared_backends = shared_backends
         self.url_scheme = url_scheme
+        # Service name -> image built by MISPDockerManager.build_images
+        self.images = images
+        # If set, the output of all the commands is written in that file instead of stdout
+        self.log_file: Optional[Path] = None
         self.config = {
-            'http_port': f'80{self.instance_id}',
-            'https_port': f'443{self.instance_id}',
+            # Two ports per instance, they can't collide whatever the number of instances
+            'http_port': ports_start + 2 * self.instance_id,
+            'https_port': ports_start + 2 * self.instance_id + 1,
             'admin_key': ''.join(random.choices(string.ascii_uppercase + string.digits, k=40)),
         }
 
@@ -48,15 +197,32 @@ class MISPDocker():
             self.config['admin_orgname'] = f'{client_node_org_name_prefix}{instance_id:0{instances_number_width}}'
             self.config['certname'] = f'{instance_id:0{instances_number_width}}{hostname_suffix}'
 
-        if self.misp_docker_dir.exists():
-            self.instance_repo = git.Repo(self.misp_docker_dir)
-            self.instance_repo.git.checkout('docker-compose.yml')
-            self.instance_repo.remote('origin').pull()
-        else:
-            self.instance_repo = git.repo.base.Repo.clone_from('https://github.com/coolacid/docker-misp.git', str(self.misp_docker_dir))
+        if (self.misp_docker_dir / 'config.json').exists():
+            # Keep the admin key and the bootstrap steps done by a previous run
+            previous_config = self.load_config()
+            for key in ('admin_key', 'bootstrap', 'cloned_from', 'misp_uuid', 'org_uuid', 'db_password'):
+                if key in previous_config:
+                    self.config[key] = previous_config[key]
+        self.config.setdefault('bootstrap', {})
+        if self.shared_backends:
+            # Slices of the shared backends used by this instance
+            self.config['db_name'] = self.config['db_user'] = self.misp_docker_dir.name.replace('-', '_')
+            self.config.setdefault('db_password', random_password())
+            self.config['redis_database'] = self.instance_id
+
+        with tracer.span('checkout', self.name):
+            self.instance_repo = checkout_worktree(mirror, self.misp_docker_dir, commit)
 
         self._prepare_docker_compose()
 
+    @property
+    def name(self) -> str:
+        return self.misp_docker_dir.name
+
+    @property
+    def project_name(self) -> str:
+        return compose_project_name(self.misp_docker_dir)
+
     @property
     def hostsfile_entry(self):
         return f"127.0.0.1    {self.config['hostname']}"
@@ -65,6 +231,32 @@ class MISPDocker():
         with (self.misp_docker_dir / 'docker-compose.yml').open() as f:
             docker_content = yaml.safe_load(f.read())
 
+        # Use the images built once for all the instances
+        for service, image in self.images.items():
+            docker_content['services'][service]['image'] = image
+
+        for service, service_config in docker_content['services'].items():
+            labels = {instance_label: self.name, service_label: service}
+            if isinstance(service_config.get('labels'), list):
+                service_config['labels'] += [f'{key}={value}' for key, value in labels.items()]
+            else:
+                service_config['labels'] = {**service_config.get('labels', {}), **labels}
+
+        # Volume with the database, can be a copy of the one of the template instance (see clone_data)
+        self.db_volume_key: Optional[str] = None
+        if self.shared_backends:
+            self._use_shared_backends(docker_content)
+        else:
+            for volume in docker_content['services']['db'].get('volumes', []):
+                if volume.split(':')[1] == '/var/lib/mysql':
+                    self.db_volume_key = volume.split(':')[0]
+
+            # Persist the redis data (the queues of the workers), so it is part of the snapshots (see snapshot_misps.py)
+            redis_volume = 'redis_data:/data'
+            if redis_volume not in docker_content['services']['redis'].get('volumes', []):
+                docker_content['services']['redis'].setdefault('volumes', []).append(redis_volume)
+                docker_content.setdefault('volumes', {})['redis_data'] = None
+
         docker_content['services']['misp']['ports'] = [f'{self.config["http_port"]}:80',
                                                        f'{self.config["https_port"]}:443']
 
@@ -86,13 +278,51 @@ class MISPDocker():
         with (self.misp_docker_dir / 'docker-compose.yml').open('w') as f:
             f.write(yaml.dump(docker_content, default_flow_style=False))
 
-        cur_dir = os.getcwd()
-        os.chdir(self.misp_docker_dir)
-        # Build the dockers
-        command = shlex.split('sudo docker-compose -f docker-compose.yml -f build-docker-compose.yml build')
-        p = Popen(command)
-        p.wait()
-        os.chdir(cur_dir)
+    def _use_shared_backends(self, docker_content: dict):
+        '''No db and redis services, the misp service uses its slice of the shared backends'''
+        for service in ('db', 'redis'):
+            docker_content['services'].pop(service, None)
+        misp = docker_content['services']['misp']
+        if 'depends_on' in misp:
+            misp['depends_on'] = [service for service in misp['depends_on'] if service not in ('db', 'redis')]
+            if not misp['depends_on']:
+                misp.pop('depends_on')
+        settings = {'MYSQL_HOST': self.shared_backends.db_host, 'MYSQL_DATABASE': self.config['db_name'],
+                    'MYSQL_USER': self.config['db_user'], 'MYSQL_PASSWORD': self.config['db_password'],
+                    'REDIS_FQDN': self.shared_backends.redis_host}
+        misp['environment'] = [variable for variable in misp['environment'] if variable.split('=')[0] not in settings]
+        misp['environment'] += [f'{key}={value}' for key, value in settings.items()]
+        for volume in ('mysql_data', 'redis_data'):
+            docker_content.get('volumes', {}).pop(volume, None)
+        if 'volumes' in docker_content and not docker_content['volumes']:
+            docker_content.pop('volumes')
+
+    def _configure_resque(self):
+        '''The background workers (CakeResque) read the redis database in a file of the image,
+        it is changed (and the workers restarted) every time the container is new.'''
+        config = '/var/www/MISP/app/Plugin/CakeResque/Config/config.php'
+        database = self.config['redis_database']
+        script = (f"grep -q \"'database' => {database},\" {config} || "
+                  f"(sed -i \"s/'database' => [0-9]*,/'database' => {database},/\" {config} && "
+                  "su -s /bin/bash www-data -c 'bash /var/www/MISP/app/Console/worker/start.sh')")
+        container = self.docker_control.container(self.misp_docker_dir, 'misp')
+        exit_code, output = self.docker_control.exec(container, ['/bin/bash', '-c', script])
+        self._log(output)
+        if exit_code != 0:
+            raise Exception(f'{self.name}: unable to set the redis database of the workers')
+
+    def _compose(self, arguments: str) -> str:
+        try:
+            return self.docker_control.compose(self.misp_docker_dir, arguments, log_file=self.log_file)
+        except Exception as e:
+            raise Exception(f'{self.name}: {e}')
+
+    def _log(self, output: str):
+        if self.log_file:
+            with self.log_file.open('a') as log:
+                log.write(output + '\n')
+        else:
+            print(output)
 
     def dump_config(self):
         with (self.misp_docker_dir / 'config.json').open('w') as f:
@@ -102,56 +332,122 @@ class MISPDocker():
         with (self.misp_docker_dir / 'config.json').open() as f:
             return json.load(f)
 
+    @property
+    def db_volume(self) -> str:
+        return f'{self.project_name}_{self.db_volume_key}'
+
+    def clone_data(self, template_volume: str, image: str):
+        '''New instance: start with a copy of the database of the template instance, right after its bootstrap.
+        Only the settings specific to this instance are changed by the bootstrap steps (see bootstrap_steps).'''
+        if not self.db_volume_key:
+            raise Exception(f'{self.name}: the database of the instance is not in a volume, it cannot be a copy')
+        if self.docker_control.volume_exists(self.db_volume):
+            return
+        with tracer.span('clone database', self.name):
+            self.docker_control.copy_volume(template_volume, self.db_volume, image,
+                                            labels={'com.docker.compose.project': self.project_name,
+                                                    'com.docker.compose.volume': self.db_volume_key})
+        self.config['cloned_from'] = template_volume
+        self.config['misp_uuid'] = str(uuid.uuid4())
+        self.config['org_uuid'] = str(uuid.uuid4())
+        # The admin user and the default organisation are in the copy
+        self.config['bootstrap'] = {name: command for name, user, command in self.bootstrap_steps if name == 'userInit'}
+        self.dump_config()
+
+    def prepare_backends(self):
+        '''What the containers need before they start'''
+        if self.shared_backends:
+            self.shared_backends.create_database(self.config['db_name'], self.config['db_user'], self.config['db_password'])
+
+    def started(self):
+        '''What needs the running containers, before the bootstrap'''
+        if self.shared_backends:
+            self._configure_resque()
+
     def run(self):
-        cur_dir = os.getcwd()
-        os.chdir(self.misp_docker_dir)
-        # Run the dockers
-        command = shlex.split('sudo docker-compose up -d')
-        p = Popen(command)
-        p.wait()
-        # Get IP on docker
-        # # Get thing to inspect
-        command = shlex.split('sudo docker-compose ps -q misp')
-        p = Popen(command, stdout=PIPE)
-        thing = p.communicate()[0].decode().strip()
-        # Yes, 4 {, we need 2 in the output string
-        command = shlex.split(f'sudo docker inspect -f "{{{{.NetworkSettings.Networks.{internal_network_name}.IPAddress}}}}"')
-        command.append(thing)
-        p = Popen(command, stdout=PIPE)
-        ip = p.communicate()[0].decode().strip()
-        os.chdir(cur_dir)
-        self.config['external_baseurl'] = f'http://{ip}'
-
-    def initial_misp_setup(self):
-        cur_dir = os.getcwd()
-        os.chdir(self.misp_docker_dir)
-        # Init admin user
-        command = shlex.split('sudo docker-compose exec -T misp /bin/bash /var/www/MISP/app/Console/cake userInit')
-        p = Popen(command)
-        p.wait()
-        # Set baseurl
-        command = shlex.split(f'sudo docker-compose exec -T --user www-data misp /bin/bash /var/www/MISP/app/Console/cake baseurl {self.config["baseurl"]}')
-        p = Popen(command)
-        p.wait()
-        # Run DB updates
-        command = shlex.split('sudo docker-compose exec -T --user www-data misp /bin/bash /var/www/MISP/app/Console/cake Admin runUpdates')
-        p = Popen(command)
-        p.wait()
-        # Set the admin key
-        command = shlex.split(f'sudo docker-compose exec -T misp /bin/bash /var/www/MISP/app/Console/cake admin change_authkey admin@admin.test {self.config["admin_key"]}')
-        p = Popen(command)
-        p.wait()
-        # Turn the instance live
-        command = shlex.split(f'sudo docker-compose exec -T --user www-data misp /bin/bash /var/www/MISP/app/Console/cake live 1')
-        p = Popen(command)
-        p.wait()
-        os.chdir(cur_dir)
+        # Run the dockers, the IPs of all the instances are fetched at once by MISPDockerManager.run_dockers
+        self.prepare_backends()
+        with tracer.span('compose up', self.name):
+            # Orphans: the db and redis services of the instance, if it used to have its own backends
+            self._compose('up -d --remove-orphans')
+        self.started()
+
+    @property
+    def bootstrap_steps(self) -> List[Tuple[str, str, str]]:
+        '''(step name, user, cake command), the user mysql means the command is an SQL query'''
+        steps = [
+            # Init admin user
+            ('userInit', 'root', 'userInit'),
+            # Set baseurl
+            ('baseurl', 'www-data', f'baseurl {self.config["baseurl"]}'),
+            # Run DB updates
+            ('runUpdates', 'www-data', 'Admin runUpdates'),
+            # Set the admin key
+            ('change_authkey', 'root', f'admin change_authkey admin@admin.test {self.config["admin_key"]}'),
+            # Turn the instance live
+            ('live', 'www-data', 'live 1'),
+        ]
+        if self.shared_backends:
+            steps.append(('redis_database', 'www-data', f'Admin setSetting MISP.redis_database {self.config["redis_database"]}'))
+        if 'cloned_from' in self.config:
+            # The UUIDs of the template instance and of its default organisation are in the copy
+            steps += [('misp_uuid', 'www-data', f'Admin setSetting MISP.uuid {self.config["misp_uuid"]}'),
+                      ('org_uuid', 'mysql', f"UPDATE organisations SET uuid='{self.config['org_uuid']}' WHERE id=1")]
+        return steps
+
+    def initial_misp_setup(self, force: bool=False):
+        '''Run all the bootstrap steps in a single exec in the container.
+        The steps already done (same cake command) are recorded in config.json and skipped, unless force is set.'''
+        to_run = [(name, user, cake_command) for name, user, cake_command in self.bootstrap_steps
+                  if force or self.config['bootstrap'].get(name) != cake_command]
+        if not to_run:
+            return
+
+        marker = 'MISP_BOOTSTRAP_STEP_DONE'
+        start_marker = 'MISP_BOOTSTRAP_STEP_START'
+        script = ''
+        for name, user, cake_command in to_run:
+            if user == 'mysql':
+                command = f'mysql -h "$MYSQL_HOST" -u "$MYSQL_USER" -p"$MYSQL_PASSWORD" "$MYSQL_DATABASE" -e {shlex.quote(cake_command)}'
+            else:
+                command = f'/bin/bash /var/www/MISP/app/Console/cake {cake_command}'
+            if user not in ('root', 'mysql'):
+                command = f'su -s /bin/bash {user} -c {shlex.quote(command)}'
+            # Each step is attempted even if the previous one failed, the timestamps are for the trace (see timing.py)
+            script += f'echo "{start_marker} {name} $(date +%s.%N)"\n'
+            script += f'if {command}; then echo "{marker} {name} $(date +%s.%N)"; fi\n'
+
+        container = self.docker_control.container(self.misp_docker_dir, 'misp')
+        _, output = self.docker_control.exec(container, ['/bin/bash', '-c', script])
+        done = []
+        started: Dict[str, float] = {}
+        for line in output.splitlines():
+            if line.startswith(start_marker):
+                started[line.split()[1]] = float(line.split()[2])
+            elif line.startswith(marker):
+                name, end = line.split()[1:3]
+                done.append(name)
+                if name in started:
+                    tracer.add(f'cake {name}', self.name, started[name], float(end))
+            else:
+                self._log(line)
+
+        for name, user, cake_command in to_run:
+            if name in done:
+                self.config['bootstrap'][name] = cake_command
+            else:
+                self.config['bootstrap'].pop(name, None)
+        self.dump_config()
+        failed = [name for name, user, cake_command in to_run if name not in done]
+        if failed:
+            raise Exception(f'{self.name}: bootstrap failed: {", ".join(failed)}')
 
 
 class MISPDockerManager():
 
     internal_network_name = internal_network_name
     number_instances = number_instances
+    instance_number_width = instance_number_width
     central_node_name = central_node_name
     hostname_suffix = hostname_suffix
     prefix_client_node = prefix_client_node
@@ -161,21 +457,37 @@ class MISPDockerManager():
     client_node_org_name_prefix = client_node_org_name_prefix
     url_scheme = url_scheme
 
-    def __init__(self, root_misps: str='misps'):
+    def __init__(self, root_misps: str='misps', number_instances: Optional[int]=None,
+                 memory_per_instance: Optional[int]=None, shared: bool=shared_backends):
+        '''memory_per_instance: budget of one instance for the admission control, 0 to disable it
+        (default: instance_memory_mb, shared_instance_memory_mb with the shared backends)'''
+        if number_instances is not None:
+            self.number_instances = number_instances
+        self.shared = shared
+        self.shared_backends: Optional[SharedBackends] = None
+        if memory_per_instance is None:
+            memory_per_instance = shared_instance_memory_mb if shared else instance_memory_mb
+        # Limits the instances brought up at the same time to what the host can take (see host_resources.py)
+        self.admission: Optional[AdmissionControl] = None
+        if memory_per_instance:
+            # The shared MySQL server and redis are counted once, not in the budget of each instance
+            reserved = reserved_memory_mb + (shared_backends_memory_mb if shared else 0)
+            self.admission = AdmissionControl(memory_per_instance, instance_cpus, reserved, admission_timeout)
         # Initialize all the repositories containing the docker images
         self.misp_instances_dir = Path(root_misps)
         self.misp_instances_dir.mkdir(exist_ok=True)
+        self.federation = Federation(self.misp_instances_dir)
         self.master_repo = git.Repo('.')
-        self.width = len(str(self.number_instances))
+        self.logs_dir = self.misp_instances_dir / 'logs'
+        # Bare mirror of docker-misp, all the checkouts below are worktrees of that one
+        self.mirror_dir = self.misp_instances_dir / 'docker-misp.git'
+        # Clean checkout of docker-misp, only used to build the images
+        self.build_dir = self.misp_instances_dir / 'docker-misp-build'
         # NOTE: self.misp_dockers[0] is the central node.
         self.misp_dockers = []
-        self._create_docker_internal_network()
-
-    def _create_docker_internal_network(self):
+        self.docker_control = DockerControl()
         # Initialize network (does nothing if already existing)
-        command = shlex.split(f'sudo docker network create --attachable --internal {self.internal_network_name}')
-        p = Popen(command)
-        p.wait()
+        self.docker_control.create_network(self.internal_network_name)
 
     @property
     def hostsfile(self) -> str:
@@ -184,22 +496,246 @@ class MISPDockerManager():
             for_hostsfile += misp_docker.hostsfile_entry + '\n'
         return for_hostsfile
 
+    def update_mirror(self) -> git.Repo:
+        '''Fetch docker-misp once per run. If the mirror is already there, a failed fetch isn't fatal (offline).'''
+        if self.mirror_dir.exists():
+            mirror = git.Repo(self.mirror_dir)
+            try:
+                with tracer.span('git fetch'):
+                    mirror.remote('origin').fetch(prune=True)
+            except git.GitCommandError as e:
+                print(f'Unable to update the docker-misp mirror, using the local copy: {e}')
+        else:
+            with tracer.span('git clone'):
+                mirror = git.repo.base.Repo.clone_from(docker_misp_repo_url, str(self.mirror_dir), mirror=True)
+        # Forget about the worktrees removed manually
+        mirror.git.worktree('prune')
+        return mirror
+
+    def build_images(self, mirror: git.Repo, commit: str) -> Dict[str, str]:
+        '''Build the docker-misp images once for all the instances.
+        Returns service name -> image tag, the build is skipped if the images already exist.'''
+        checkout_worktree(mirror, self.build_dir, commit)
+        with (self.build_dir / 'build-docker-compose.yml').open() as f:
+            build_content = yaml.safe_load(f.read())
+        with (self.build_dir / 'docker-compose.yml').open() as f:
+            docker_content = yaml.safe_load(f.read())
+
+        # Service name -> image name set by docker-compose when building
+        built_images = {}
+        contexts = []
+        for service, service_config in build_content['services'].items():
+            if 'build' not in service_config:
+                continue
+            build = service_config['build']
+            contexts.append(build if isinstance(build, str) else build.get('context', '.'))
+            built_images[service] = service_config.get('image', docker_content['services'][service].get('image'))
+
+        tooling = tooling_dockerfile.format(base_image='{base_image}', packages=' '.join(refresh_packages))
+        inputs_hash = hash_build_inputs(self.build_dir, contexts, tooling)[:12]
+        images = {service: f'{image_repository}:{service}-{commit[:12]}-{inputs_hash}' for service in built_images}
+
+        if all(self.docker_control.image_exists(image) for image in images.values()):
+            print('Images already built:', ', '.join(images.values()))
+            return images
+
+        with tracer.span('compose build', commit=commit):
+            self.docker_control.compose(self.build_dir, '-f docker-compose.yml -f build-docker-compose.yml build')
+        for service, image in images.items():
+            if service == 'misp':
+                with tracer.span('build tooling layer', image=image):
+                    self.docker_control.build_image(tooling.format(base_image=built_images[service]), image)
+            else:
+                self.docker_control.tag_image(built_images[service], image)
+        return images
+
     def initialize_config_files(self):
+        mirror = self.update_mirror()
+        commit = mirror.head.commit.hexsha
+        images = self.build_images(mirror, commit)
+        if self.shared:
+            self.shared_backends = SharedBackends(self.misp_instances_dir, self.build_dir, self.number_instances,
+                                                  self.docker_control)
         for instance_id in range(self.number_instances + 1):
-            misp_docker = MISPDocker(self.misp_instances_dir, instance_id, self.width, self.url_scheme)
+            misp_docker = MISPDocker(self.misp_instances_dir, instance_id, self.instance_number_width, self.url_scheme,
+                                     mirror, commit, images, self.docker_control, self.shared_backends)
             self.misp_dockers.append(misp_docker)
-
-    def run_dockers(self):
+        self.record_instances()
+
+    def record_instances(self):
+        '''Keep the list of the instances for the scripts working on all of them (stop_misps.py).
+        The instances of a previous run with more instances stay in the list.'''
+        names = [path.name for path in known_instances(self.misp_instances_dir)]
+        names += [misp_docker.name for misp_docker in self.misp_dockers if misp_docker.name not in names]
+        with (self.misp_instances_dir / 'instances.json').open('w') as f:
+            json.dump(names, f, indent=2)
+
+    def prepare_template(self) -> Optional[Tuple[str, str]]:
+        '''Copy of the database of the central node, right after its bootstrap. Returns (volume, image of the db service),
+        None if the central node already has its sync setup (it would be in the copy too) and there is no copy yet.'''
+        template = self.misp_dockers[0]
+        volume = f'{template.db_volume}-template'
+        image = self.docker_control.container(template.misp_docker_dir, 'db', stopped=True).image.id
+        if self.docker_control.volume_exists(volume):
+            return volume, image
+        if (template.misp_docker_dir / 'sync_state.json').exists():
+            print(f'{template.name} is already configured, it cannot be used as template.')
+            return None
+        # Consistent copy: nothing writes in the database meanwhile
+        with tracer.span('copy template', template.name):
+            template._compose('stop misp db')
+            try:
+                self.docker_control.copy_volume(template.db_volume, volume, image)
+            finally:
+                template._compose('start db misp')
+        return volume, image
+
+    def _bring_up(self, misp_docker: MISPDocker, force_bootstrap: bool, template: Optional[Tuple[str, str]]=None,
+                  federated: bool=False) -> float:
+        # An instance already running doesn't need more resources
+        admitted = bool(self.admission) and not federated and not self.docker_control.is_running(misp_docker.misp_docker_dir, 'misp')
+        if admitted:
+            with tracer.span('wait for resources', misp_docker.name):
+                self.admission.acquire(misp_docker.name)
+        start = time.time()
+        try:
+            with tracer.span('bring up', misp_docker.name):
+                if template:
+                    misp_docker.clone_data(*template)
+                if federated:
+                    # Already started with all the others, see _start_federation
+                    misp_docker.started()
+                else:
+                    misp_docker.run()
+                misp_docker.initial_misp_setup(force_bootstrap)
+        finally:
+            if admitted:
+                self.admission.release()
+        return time.time() - start
+
+    def _update_ips(self):
+        '''IP of all the instances on the internal network, in one request'''
+        with tracer.span('ip lookup'):
+            ips = self.docker_control.service_ips(self.internal_network_name, 'misp')
         for misp_docker in self.misp_dockers:
-            misp_docker.run()
-            misp_docker.initial_misp_setup()
+            if misp_docker.name in ips:
+                misp_docker.config['external_baseurl'] = f'http://{ips[misp_docker.name]}'
             misp_docker.dump_config()
 
+    def _bring_up_all(self, misp_dockers: List[MISPDocker], workers: int, force_bootstrap: bool,
+                      template: Optional[Tuple[str, str]], durations: Dict[str, float], failures: Dict[str, str],
+                      federated: bool=False):
+        def log_error(misp_docker: MISPDocker):
+            if misp_docker.log_file:
+                with misp_docker.log_file.open('a') as log:
+                    traceback.print_exc(file=log)
+            else:
+                traceback.print_exc()
+
+        done, failed = run_parallel(lambda misp_docker: self._bring_up(misp_docker, force_bootstrap, template, federated),
+                                    misp_dockers, workers, done='is up', on_error=log_error)
+        durations.update(done)
+        failures.update(failed)
+
+    def _start_federation(self):
+        '''All the instances and the nginx proxy in one compose project, started by one docker-compose call'''
+        nginx_dir = nginx_root if (nginx_root / 'docker-compose.yml').exists() else None
+        with tracer.span('generate federation'):
+            self.federation.generate([misp_docker.misp_docker_dir for misp_docker in self.misp_dockers], nginx_dir)
+        # Same containers names and ports in their own projects: those are removed (the volumes are kept)
+        for project_dir in [misp_docker.misp_docker_dir for misp_docker in self.misp_dockers] + ([nginx_dir] if nginx_dir else []):
+            if self.docker_control.project_containers(project_dir):
+                with tracer.span('compose down', project_dir.name):
+                    self.docker_control.compose(project_dir, 'down')
+        for misp_docker in self.misp_dockers:
+            misp_docker.prepare_backends()
+        with tracer.span('compose up', 'federation'):
+            self.federation.compose(self.docker_control, 'up -d --remove-orphans')
+
+    def _stop_federation(self):
+        '''Back to one project per instance'''
+        with tracer.span('compose down', 'federation'):
+            self.federation.compose(self.docker_control, 'down')
+        for path in (self.federation.project_dir / 'docker-compose.yml', self.federation.services_file):
+            if path.exists():
+                path.unlink()
+
+    def run_dockers(self, workers: int=bringup_workers, force_bootstrap: bool=False, from_template: bool=False,
+                    federation: bool=False) -> Dict[str, str]:
+        '''Start and initialize all the instances, at most *workers* at the same time.
+        A failing instance doesn't stop the other ones, the failures are returned (name -> error).
+        from_template: the central node is initialized first, the new instances start with a copy of its database.
+        federation: all the instances in one compose project (see Federation), started at once.'''
+        if workers > 1:
+            # The outputs would be interleaved on stdout, one log file per instance.
+            self.logs_dir.mkdir(exist_ok=True)
+            for misp_docker in self.misp_dockers:
+                misp_docker.log_file = self.logs_dir / f'{misp_docker.name}.log'
+                misp_docker.log_file.write_text('')
+
+        if from_template and self.shared_backends:
+            raise Exception('The instances using the shared backends cannot be copies of a template (no database volume per instance)')
+        if from_template and federation:
+            raise Exception('The instances of the federation are started together, they cannot be copies of a template')
+        durations: Dict[str, float] = {}
+        failures: Dict[str, str] = {}
+        if not federation and self.federation.enabled:
+            self._stop_federation()
+        if federation:
+            # Everything starts with one docker-compose up: the budget of the whole federation is checked up front
+            starting = [misp_docker for misp_docker in self.misp_dockers
+                        if not self.docker_control.is_running(misp_docker.misp_docker_dir, 'misp')]
+            if self.admission:
+                self.admission.acquire_all(len(starting), 'federation')
+            try:
+                self._start_federation()
+                self._bring_up_all(self.misp_dockers, workers, force_bootstrap, None, durations, failures, federated=True)
+            finally:
+                if self.admission:
+                    for _ in starting:
+                        self.admission.release()
+        elif from_template:
+            self._bring_up_all(self.misp_dockers[:1], workers, force_bootstrap, None, durations, failures)
+            template = self.prepare_template() if not failures else None
+            self._bring_up_all(self.misp_dockers[1:], workers, force_bootstrap, template, durations, failures)
+        else:
+            self._bring_up_all(self.misp_dockers, workers, force_bootstrap, None, durations, failures)
+        self._update_ips()
+
+        log_files = {misp_docker.name: misp_docker.log_file for misp_docker in self.misp_dockers}
+        print_summary([misp_docker.name for misp_docker in self.misp_dockers], durations, failures,
+                      details=lambda name: f' - log: {log_files[name]}' if log_files[name] else '')
+        if self.admission:
+            print(self.admission.capacity(len(self.misp_dockers) - len(failures)))
+        return failures
+
 
 if __name__ == '__main__':
-    manager = MISPDockerManager()
+    parser = argparse.ArgumentParser(description='Initialize the MISP instances.')
+    parser.add_argument('--workers', type=int, default=bringup_workers,
+                        help='Number of instances brought up at the same time (1: one after the other, output on stdout).')
+    parser.add_argument('--instances', type=int, default=number_instances,
+                        help='Number of client instances (the central node is always created).')
+    parser.add_argument('--force-bootstrap', action='store_true',
+                        help='Run all the bootstrap steps, even the ones recorded as done in config.json.')
+    parser.add_argument('--from-template', action='store_true',
+                        help='Initialize the central node first, the new instances start with a copy of its database.')
+    parser.add_argument('--shared-backends', action='store_true', default=shared_backends,
+                        help='One MySQL server and one redis for all the instances.')
+    parser.add_argument('--federation', action='store_true',
+                        help='All the instances and the nginx proxy in one compose project, started by one docker-compose call.')
+    parser.add_argument('--memory-per-instance', type=int,
+                        help='Memory (MB) needed by one instance, the bring up waits until the host has it (0: no limit). '
+                             f'Default: {instance_memory_mb}, {shared_instance_memory_mb} with --shared-backends.')
+    args = parser.parse_args()
+
+    manager = MISPDockerManager(number_instances=args.instances, memory_per_instance=args.memory_per_instance,
+                                shared=args.shared_backends)
     manager.initialize_config_files()
-    manager.run_dockers()
+    manager.run_dockers(args.workers, args.force_bootstrap, args.from_template, args.federation)
+    tracer.dump(manager.logs_dir / 'init_misps-trace.json')
+    print(tracer.summary())
+    print(f'Trace (chrome://tracing or https://ui.perfetto.dev): {manager.logs_dir / "init_misps-trace.json"}')
 
     print('Entries for /etc/hosts:')
     print(manager.hostsfile)
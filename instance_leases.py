@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import fcntl
+import time
+from pathlib import Path
+
+from typing import List, IO, Optional
+
+from .setup_sync import MISPInstance
+
+
+class InstanceLeases():
+    '''Exclusive use of MISP instances by one test at a time, across threads and processes (nose --processes).
+    Uses one lock file per instance, the locks are released when the lease (or the process) ends.'''
+
+    def __init__(self, locks_dir: Path, instances: List[MISPInstance]):
+        self.locks_dir = locks_dir
+        self.locks_dir.mkdir(exist_ok=True)
+        self.instances = instances
+
+    def _try_lock(self, instance: MISPInstance) -> IO:
+        lock_file = (self.locks_dir / f'{instance.directory_name}.lock').open('w')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock_file.close()
+            raise
+        return lock_file
+
+    @staticmethod
+    def _linked(a: MISPInstance, b: MISPInstance) -> bool:
+        # The tests push and pull in both directions between consecutive instances
+        return b.name in a.synchronisations and a.name in b.synchronisations
+
+    def _find_path(self, count: int, chosen: List[MISPInstance], locks: Optional[List[IO]]=None) -> bool:
+        '''Depth-first search of *count* instances, each one linked (both ways) to the next one, extending *chosen*.
+        With locks, only the free instances are used: they are locked on the way, and released when backtracking.'''
+        if len(chosen) == count:
+            return True
+        for instance in self.instances:
+            if instance in chosen or (chosen and not self._linked(chosen[-1], instance)):
+                continue
+            if locks is not None:
+                try:
+                    locks.append(self._try_lock(instance))
+                except BlockingIOError:
+                    continue
+            chosen.append(instance)
+            if self._find_path(count, chosen, locks):
+                return True
+            chosen.pop()
+            if locks is not None:
+                locks.pop().close()
+        return False
+
+    def acquire(self, count: int, timeout: int=3600) -> 'Lease':
+        '''Lease *count* instances, each one linked (both ways) to the next one.'''
+        if not self._find_path(count, []):
+            # Waiting for the other tests wouldn't help
+            raise Exception(f'Unable to lease {count} instances: the sync topology has no path of {count} instances '
+                            'linked both ways (see ./setup_sync.py --topology)')
+        deadline = time.time() + timeout
+        while True:
+            chosen: List[MISPInstance] = []
+            locks: List[IO] = []
+            if self._find_path(count, chosen, locks):
+                return Lease(chosen, locks)
+            if time.time() > deadline:
+                raise Exception(f'Unable to lease {count} linked instances in {timeout}s')
+            time.sleep(1)
+
+
+class Lease():
+
+    def __init__(self, instances: List[MISPInstance], locks: List[IO]):
+        self.instances = instances
+        self._locks = locks
+
+    def release(self):
+        for lock_file in self._locks:
+            # Closing the file releases the lock
+            lock_file.close()
+        self._locks = []
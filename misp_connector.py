@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import threading
+import time
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry  # type: ignore
+
+from pymisp import PyMISP
+
+from typing import Optional
+
+try:
+    from .api_metrics import ApiMetrics
+except ImportError:
+    # Imported by ./setup_sync.py run as a script
+    from api_metrics import ApiMetrics
+
+
+def connection_pool(pool_size: int, connect_retries: int=3) -> HTTPAdapter:
+    '''Connection pool (keep-alive) shared by all the connectors of one instance.
+    Only the connection errors are retried: the request never reached MISP, it is safe for POST too.'''
+    retries = Retry(total=connect_retries, connect=connect_retries, read=0, redirect=0, status=0, backoff_factor=0.5)
+    return HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retries)
+
+
+class MeteredSession(requests.Session):
+    '''Session sending through a shared connection pool, the requests are recorded in metrics if it is set'''
+
+    def __init__(self, pool: HTTPAdapter, root_url: str, metrics: Optional[ApiMetrics]=None, labels: tuple=('', '')):
+        super().__init__()
+        self.mount('http://', pool)
+        self.mount('https://', pool)
+        self.metrics = metrics
+        self.metrics_labels = labels
+        self.root_path = urlparse(root_url).path.rstrip('/')
+
+    def send(self, request: requests.PreparedRequest, **kwargs) -> requests.Response:
+        start = time.time()
+        response = super().send(request, **kwargs)
+        if self.metrics:
+            path = urlparse(request.url).path[len(self.root_path):]
+            body = request.body.encode() if isinstance(request.body, str) else request.body
+            self.metrics.record(*self.metrics_labels, request.method, path, response.status_code, time.time() - start,
+                                len(body or b''), len(response.content))
+        return response
+
+    def close(self):
+        # The pool is shared with the other connectors of the instance, closing the session must not close it
+        pass
+
+
+class PooledPyMISP(PyMISP):
+    '''PyMISP keeps one session per connector, this one sends through a connection pool that can be shared
+    between connectors of the same instance, with one session per thread: requests.Session isn't documented as
+    thread-safe (cookies, redirects), the connection pool is.
+    NOTE: the sessions (and their cookies) aren't shared, each connector is a different user.
+    If metrics is set, all the requests are recorded there, with the name of the instance and the role of the user.'''
+
+    def __init__(self, url: str, key: str, pool: HTTPAdapter, metrics: Optional[ApiMetrics]=None, instance: str='',
+                 role: str='', **kwargs):
+        # Must exist before PyMISP.__init__, it already queries the instance.
+        self._pool = pool
+        self._metrics = metrics
+        self._metrics_labels = (instance, role)
+        self._sessions = threading.local()
+        super().__init__(url, key, **kwargs)
+
+    @property
+    def _PyMISP__session(self) -> MeteredSession:
+        '''The session PyMISP sends all its requests through (self.__session in PyMISP), one per thread'''
+        session = getattr(self._sessions, 'session', None)
+        if session is None:
+            session = MeteredSession(self._pool, self.root_url, self._metrics, self._metrics_labels)
+            self._sessions.session = session
+        return session
+
+    @_PyMISP__session.setter
+    def _PyMISP__session(self, session: requests.Session):
+        # The session created by PyMISP.__init__ is replaced by the ones of the threads
+        session.close()
@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+from datetime import datetime, timezone
+import re
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Optional, Set, Tuple
+
+from pymisp import MISPEvent
+
+from .setup_sync import MISPInstance
+from .generic_config import propagation_timeout
+
+# Jobs involved in the propagation of an event (the automatic push is done by publish_event)
+sync_job_types = ('publish_event', 'push', 'pull')
+# The jobs index is read page by page, until the jobs are older than the trace
+jobs_page_size = 100
+max_jobs_pages = 20
+# Delay between two polls of a downstream instance, in seconds
+poll_interval = 0.2
+
+
+def parse_job_date(date: str) -> Optional[float]:
+    '''The dates of the jobs are in the timezone of the container (UTC in docker-misp)'''
+    try:
+        return datetime.strptime(date, '%Y-%m-%d %H:%M:%S').replace(tzinfo=timezone.utc).timestamp()
+    except (TypeError, ValueError):
+        return None
+
+
+class PropagationTrace():
+    '''Timeline of one event: published on the source, sync jobs on each instance, first time visible on each instance.
+    From the publication, all the downstream instances are polled at the same time (one thread per instance), the
+    visibility times don't depend on the order the test waits for the instances.'''
+
+    def __init__(self, event: MISPEvent, source: MISPInstance, downstream: List[MISPInstance], timeout: int=propagation_timeout):
+        self.event_uuid = event.uuid
+        self.source = source
+        self.downstream = downstream
+        self.timeout = timeout
+        self.start = time.time()
+        self.published_at: Optional[float] = None
+        # (timestamp, instance name, description)
+        self.entries: List[Tuple[float, str, str]] = []
+        # Instance name -> ID of the event on that instance (the jobs refer to it)
+        self.event_ids: Dict[str, str] = {source.name: str(event.id)}
+        # Instance name -> timestamp when the event was first seen on that instance
+        self.first_seen: Dict[str, float] = {}
+        self._stop = threading.Event()
+        self._executor: Optional[ThreadPoolExecutor] = None
+
+    def published(self):
+        '''Call it right after the publication, the polling of the downstream instances starts'''
+        self.published_at = time.time()
+        self.entries.append((self.published_at, self.source.name, 'published'))
+        self._executor = ThreadPoolExecutor(max_workers=len(self.downstream))
+        for instance in self.downstream:
+            self._executor.submit(self._watch, instance)
+
+    def _watch(self, instance: MISPInstance):
+        deadline = time.time() + self.timeout
+        while not self._stop.is_set() and time.time() < deadline:
+            found = instance.site_admin_connector.get_event(self.event_uuid)
+            if isinstance(found, MISPEvent):
+                self.first_seen[instance.name] = time.time()
+                self.event_ids[instance.name] = str(found.id)
+                return
+            self._stop.wait(poll_interval)
+
+    def stop(self):
+        '''Stop polling the instances where the event isn't visible yet'''
+        self._stop.set()
+        if self._executor:
+            self._executor.shutdown(wait=True)
+
+    def _sync_jobs(self, instance: MISPInstance) -> List[dict]:
+        '''Sync jobs queued since the beginning of the trace, on all the pages of the jobs index'''
+        jobs: List[dict] = []
+        for page in range(1, max_jobs_pages + 1):
+            # NOTE: the jobs index isn't exposed by PyMISP
+            response = instance.site_admin_connector.direct_call(
+                f'jobs/index/sort:id/direction:desc/page:{page}/limit:{jobs_page_size}')
+            if not isinstance(response, list):
+                print(f'{instance.name}: unable to get the jobs: {response}')
+                break
+            for job in response:
+                job = job.get('Job', {})
+                queued = parse_job_date(job.get('date_created'))
+                if queued is not None and queued < int(self.start):
+                    # Newest first, the remaining jobs are older than the trace
+                    return jobs
+                if queued is not None and job.get('job_type') in sync_job_types:
+                    jobs.append(job)
+            if len(response) < jobs_page_size:
+                break
+        return jobs
+
+    @staticmethod
+    def _related(job: dict, event_id: Optional[str], server_ids: Set[str]) -> bool:
+        '''job_input is "Event ID: <id>" for publish_event, "Server: <id>" for push and pull'''
+        number = re.search(r'\d+', job.get('job_input') or '')
+        if not number:
+            return False
+        if job['job_type'] == 'publish_event':
+            return number.group() == event_id
+        return number.group() in server_ids
+
+    def collect(self):
+        '''Get the sync jobs of the traced event started since the beginning of the trace, and the visibility times'''
+        self.stop()
+        traced = {instance.name for instance in [self.source] + self.downstream}
+        for instance in [self.source] + self.downstream:
+            # The links between the instances of the trace, the jobs of the other links are about other events
+            server_ids = {str(server.id) for name, server in instance.synchronisations.items() if name in traced}
+            for job in self._sync_jobs(instance):
+                if not self._related(job, self.event_ids.get(instance.name), server_ids):
+                    continue
+                queued = parse_job_date(job['date_created'])
+                self.entries.append((queued, instance.name, f'{job["job_type"]} job {job["id"]} queued ({job.get("job_input")})'))
+                finished = parse_job_date(job.get('date_modified'))
+                if str(job.get('status')) == '4' and finished:
+                    self.entries.append((finished, instance.name, f'{job["job_type"]} job {job["id"]} finished'))
+        for name, timestamp in self.first_seen.items():
+            self.entries.append((timestamp, name, 'visible'))
+
+    @property
+    def hops(self) -> Dict[str, Optional[float]]:
+        '''Instance name -> time between the publication and the first time the event was visible'''
+        return {instance.name: (self.first_seen[instance.name] - self.published_at
+                                if self.published_at and instance.name in self.first_seen else None)
+                for instance in self.downstream}
+
+    def timeline(self) -> str:
+        origin = self.published_at or self.start
+        name_width = max(len(instance.name) for instance in [self.source] + self.downstream)
+        lines = [f'Propagation of {self.event_uuid}:']
+        for timestamp, name, description in sorted(self.entries):
+            # NOTE: the job dates have a 1s resolution
+            lines.append(f'  {timestamp - origin:+8.2f}s  {name.ljust(name_width)}  {description}')
+        previous = 0.
+        for name, delay in self.hops.items():
+            if delay is None:
+                lines.append(f'  {name}: never visible')
+                continue
+            lines.append(f'  {name}: visible after {delay:.2f}s (+{delay - previous:.2f}s from the previous hop)')
+            previous = delay
+        return '\n'.join(lines)
@@ -1,24 +1,47 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
-import os
-from subprocess import Popen
+import argparse
 import shlex
+import time
 from pathlib import Path
-from generic_config import prefix_client_node
+
+from generic_config import prefix_client_node, refresh_packages, refresh_workers
+from docker_control import DockerControl, run_parallel, print_summary
 
 misps_root = Path('misps')
+# Prints the missing packages, fails if there is any
+check_packages = (f'missing=""; for package in {" ".join(shlex.quote(package) for package in refresh_packages)}; '
+                  'do command -v "$package" >/dev/null || missing="$missing $package"; done; echo $missing; [ -z "$missing" ]')
+
+
+def refresh(docker_control: DockerControl, misp_dir: Path, log_file: Path) -> float:
+    start = time.time()
+    container = docker_control.container(misp_dir, 'misp')
+    # The packages are in the image built by init_misps.py. One check per package: with several names,
+    # the exit status of command -v only reflects the last one (dash)
+    exit_code, output = docker_control.exec(container, ['/bin/sh', '-c', check_packages])
+    if exit_code != 0:
+        raise Exception(f'{misp_dir.name}: {", ".join(output.split())} missing in the image, re-run init_misps.py')
+    exit_code, output = docker_control.exec(container, ['bash', '/var/www/MISP/misp-refresh/refresh.sh'])
+    log_file.write_text(output)
+    if exit_code != 0:
+        raise Exception(f'{misp_dir.name}: refresh.sh failed (exit code {exit_code})')
+    return time.time() - start
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run misp-refresh on all the client instances.')
+    parser.add_argument('--workers', type=int, default=refresh_workers, help='Number of instances refreshed at the same time.')
+    args = parser.parse_args()
+
+    docker_control = DockerControl()
+    logs_dir = misps_root / 'logs'
+    logs_dir.mkdir(exist_ok=True)
+    misp_dirs = sorted(misps_root.glob(f'{prefix_client_node}*'))
 
-for misp_dir in misps_root.glob(f'{prefix_client_node}*'):
-    cur_dir = os.getcwd()
-    os.chdir(misp_dir)
-    command = shlex.split('sudo docker-compose exec misp apt update')
-    p = Popen(command)
-    p.wait()
-    command = shlex.split('sudo docker-compose exec misp apt install -y jq curl dialog')
-    p = Popen(command)
-    p.wait()
-    command = shlex.split('sudo docker-compose exec misp bash /var/www/MISP/misp-refresh/refresh.sh')
-    p = Popen(command)
-    p.wait()
-    os.chdir(cur_dir)
+    durations, failures = run_parallel(
+        lambda misp_dir: refresh(docker_control, misp_dir, logs_dir / f'{misp_dir.name}-refresh.log'),
+        misp_dirs, args.workers, done='refreshed')
+    print_summary([misp_dir.name for misp_dir in misp_dirs], durations, failures,
+                  details=lambda name: f' - log: {logs_dir / f"{name}-refresh.log"}')
@@ -1,20 +1,45 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
+import argparse
 import json
+import os
 from pathlib import Path
-from pymisp import PyMISP, MISPOrganisation, MISPUser, MISPSharingGroup, MISPTag, MISPServer
+from pymisp import PyMISP, MISPOrganisation, MISPUser, MISPSharingGroup, MISPTag, MISPServer, MISPEvent, AbstractMISP
 import random
 import string
 import csv
-
-from typing import List
-
-from .generic_config import central_node_name, prefix_client_node, secure_connection
+import subprocess
+import sys
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import List, Optional, Union, Dict, Iterable, Tuple
+
+try:
+    from .misp_connector import PooledPyMISP, connection_pool
+    from .topology import SyncLink, sync_links
+    from .timing import tracer
+    from .api_metrics import api_metrics
+    from .generic_config import (central_node_name, prefix_client_node, secure_connection, propagation_timeout,
+                                 workers_timeout, max_requests_per_instance, sync_topology, sync_tree_fanout)
+except ImportError:
+    # Run as a script (./setup_sync.py) like the other top-level scripts, not imported from the tests
+    from misp_connector import PooledPyMISP, connection_pool
+    from topology import SyncLink, sync_links
+    from timing import tracer
+    from api_metrics import api_metrics
+    from generic_config import (central_node_name, prefix_client_node, secure_connection, propagation_timeout,
+                                workers_timeout, max_requests_per_instance, sync_topology, sync_tree_fanout)
 
 
 class MISPInstance():
 
-    def __init__(self, misp_instance_dir: Path, secure_connection: bool):
+    # Kind of objects in the lookup index -> attribute used as key
+    index_keys = {'users': 'email', 'organisations': 'name', 'tags': 'name', 'servers': 'name', 'sharing_groups': 'name'}
+
+    def __init__(self, misp_instance_dir: Path, secure_connection: bool, read_only: bool=False):
+        '''read_only: only load what ./setup_sync.py created (see _load_setup), nothing is changed on the instance'''
         with (misp_instance_dir / 'config.json').open() as f:
             self.instance_config = json.load(f)
 
@@ -23,29 +48,150 @@ class MISPInstance():
 
         self.synchronisations = {}
         self.name = self.instance_config['admin_orgname']
+        # Name of the instance in the topologies (misp-central, misp-1, ...)
+        self.directory_name = misp_instance_dir.name
+        # Limits the number of concurrent requests sent to that instance (see MISPInstances)
+        self.request_slots = threading.BoundedSemaphore(max_requests_per_instance)
+        # Keep-alive connections shared by all the connectors of that instance
+        self.connection_pool = connection_pool(max_requests_per_instance)
+        # Event UUID -> time (in seconds) it took to be visible on this instance (see wait_for_event)
+        self.propagation_delays: Dict[str, float] = {}
+        # Kind -> key -> object, each kind is filled with one bulk fetch (see _lookup)
+        self._index: Dict[str, Dict[str, AbstractMISP]] = {}
+        # Kind -> key -> object created or updated through this instance, newer than what a bulk fetch may return
+        self._remembered: Dict[str, Dict[str, AbstractMISP]] = {}
+        self._index_lock = threading.Lock()
+
+        self.baseurl = self.instance_config['baseurl']
+        self.external_baseurl = self.instance_config['external_baseurl']
 
+        # IDs and keys of everything created on that instance, to only redo what is missing on a re-run
+        self.state_file = misp_instance_dir / 'sync_state.json'
+        self._state_lock = threading.Lock()
+        if self.state_file.exists():
+            with self.state_file.open() as f:
+                self.state = json.load(f)
+        else:
+            self.state = {}
+        for key in ('users', 'settings', 'sync_configs', 'servers'):
+            self.state.setdefault(key, {})
+
+        if read_only:
+            self._load_setup()
+        else:
+            self._setup()
+        # And connectors
+        self.org_admin_connector = self.connector(self.orgadmin.authkey, 'org_admin')
+        self.user_connector = self.connector(self.user.authkey, 'user')
+
+    def __repr__(self):
+        return f'<{self.__class__.__name__}(external={self.baseurl})>'
+
+    def _setup(self):
+        with tracer.span('site admin', self.directory_name):
+            if not self._resume_site_admin():
+                # Nothing known on that instance (or it was reset)
+                self.state = {'users': {}, 'settings': {}, 'sync_configs': {}, 'servers': {}}
+                self._create_site_admin()
+
+        with tracer.span('server settings', self.directory_name):
+            # Setup external_baseurl
+            self._set_server_setting('MISP.external_baseurl', self.external_baseurl, force=True)
+            # Setup baseurl
+            self._set_server_setting('MISP.baseurl', self.baseurl, force=True)
+            # Setup host org
+            self._set_server_setting('MISP.host_org_id', self.host_org.id)
+
+        with tracer.span('users', self.directory_name):
+            # create other useful users
+            self.orgadmin = self.create_user(self.instance_config['email_orgadmin'], 2)
+            self.user = self.create_user(self.instance_config['email_user'], 3)
+
+    def _load_setup(self):
+        '''Users and sync servers from the state file, without changing anything on the instance or in the state.
+        Used by the tests: they may run in parallel processes, only ./setup_sync.py configures the instances.'''
+        if not self._resume_site_admin():
+            raise Exception(f'{self.name}: not set up (or reset), run ./setup_sync.py first')
+        self.orgadmin = self._known_user(self.instance_config['email_orgadmin'])
+        self.user = self._known_user(self.instance_config['email_user'])
+        if not self.orgadmin or not self.user:
+            raise Exception(f'{self.name}: users missing, run ./setup_sync.py again')
+        for server_name, known in self.state['servers'].items():
+            server = self._lookup('servers', server_name)
+            if not server or server.id != known['id']:
+                raise Exception(f'{self.name}: {server_name} is gone, run ./setup_sync.py again')
+            if 'push' not in known:
+                # State written before the push/pull flags were recorded
+                raise Exception(f'{self.name}: flags of {server_name} unknown, run ./setup_sync.py again')
+            self.synchronisations[server_name.replace('Sync with ', '')] = server
+
+    def configured_sync(self, name: str) -> Tuple[bool, bool]:
+        '''(push, pull) of the server of the instance *name*, as set by ./setup_sync.py.
+        Not the live values: a test running in an other process may have changed them on its leased instances.'''
+        known = self.state['servers'][f'Sync with {name}']
+        return known['push'], known['pull']
+
+    def _update_state(self, section: str, key: str, value):
+        with self._state_lock:
+            if section:
+                self.state[section][key] = value
+            else:
+                self.state[key] = value
+            # Written and renamed: the file may be read by an other process (tests running in parallel)
+            tmp_file = self.state_file.with_name(f'{self.state_file.name}.{os.getpid()}.tmp')
+            with tmp_file.open('w') as f:
+                json.dump(self.state, f, indent=2)
+            tmp_file.replace(self.state_file)
+
+    def _record_user(self, user: MISPUser):
+        self._update_state('users', user.email, {'id': user.id, 'authkey': user.authkey})
+
+    def _known_user(self, email: str) -> Optional[MISPUser]:
+        '''User from the state file, if it still exists on the instance'''
+        known = self.state['users'].get(email)
+        if not known:
+            return None
+        user = self.site_admin_connector.get_user(known['id'])
+        if not isinstance(user, MISPUser) or user.email != email:
+            return None
+        if not getattr(user, 'authkey', None):
+            user.authkey = known['authkey']
+        return user
+
+    def _resume_site_admin(self) -> bool:
+        '''Re-use the site admin and the host org from the state file, if they are still valid'''
+        known = self.state['users'].get(self.instance_config['email_site_admin'])
+        if not known or 'host_org_id' not in self.state:
+            return False
+        try:
+            self.site_admin_connector = self.connector(known['authkey'], 'site_admin')
+        except Exception:
+            # Invalid key, the instance was probably reset
+            return False
+        self.host_org = self.site_admin_connector.get_organisation(self.state['host_org_id'])
+        if not isinstance(self.host_org, MISPOrganisation) or self.host_org.name != self.instance_config['admin_orgname']:
+            return False
+        self.host_site_admin = self._known_user(self.instance_config['email_site_admin'])
+        return self.host_site_admin is not None
+
+    def _create_site_admin(self):
         # NOTE: never use that user again after initial config.
-        initial_user_connector = PyMISP(self.instance_config['baseurl'], self.instance_config['admin_key'], ssl=self.secure_connection, debug=False)
+        initial_user_connector = self.connector(self.instance_config['admin_key'], 'initial_admin')
         # Set the default role (id 3 is normal user)
         initial_user_connector.set_default_role(3)
-        initial_user_connector.toggle_global_pythonify()
-
-        self.baseurl = self.instance_config['baseurl']
-        self.external_baseurl = self.instance_config['external_baseurl']
 
         # Create organisation
         organisation = MISPOrganisation()
         organisation.name = self.instance_config['admin_orgname']
         self.host_org = initial_user_connector.add_organisation(organisation)
-        if not isinstance(self.host_org, MISPOrganisation):
+        if isinstance(self.host_org, MISPOrganisation):
+            self._remember('organisations', self.host_org)
+        else:
             # The organisation is probably already there
-            organisations = initial_user_connector.organisations()
-            for organisation in organisations:
-                if organisation.name == self.instance_config['admin_orgname']:
-                    self.host_org = organisation
-                    break
-            else:
+            self.host_org = self._lookup('organisations', self.instance_config['admin_orgname'], initial_user_connector, refresh_on_miss=True)
+            if not self.host_org:
                 raise Exception('Unable to find admin organisation')
+        self._update_state('', 'host_org_id', self.host_org.id)
 
         # Create Site admin in new org
         user = MISPUser()
@@ -53,103 +199,177 @@ class MISPInstance():
         user.org_id = self.host_org.id
         user.role_id = 1  # Site admin
         self.host_site_admin = initial_user_connector.add_user(user)
-        if not isinstance(self.host_site_admin, MISPUser):
-            users = initial_user_connector.users()
-            for user in users:
-                if user.email == self.instance_config['email_site_admin']:
-                    self.host_site_admin = user
-                    break
-            else:
+        if isinstance(self.host_site_admin, MISPUser):
+            self._remember('users', self.host_site_admin)
+        else:
+            self.host_site_admin = self._lookup('users', self.instance_config['email_site_admin'], initial_user_connector, refresh_on_miss=True)
+            if not self.host_site_admin:
                 raise Exception('Unable to find admin user')
-
-        self.site_admin_connector = PyMISP(self.baseurl, self.host_site_admin.authkey, ssl=self.secure_connection, debug=False)
-        self.site_admin_connector.toggle_global_pythonify()
-
-        # Setup external_baseurl
-        self.site_admin_connector.set_server_setting('MISP.external_baseurl', self.external_baseurl, force=True)
-        # Setup baseurl
-        self.site_admin_connector.set_server_setting('MISP.baseurl', self.baseurl, force=True)
-        # Setup host org
-        self.site_admin_connector.set_server_setting('MISP.host_org_id', self.host_org.id)
-
-        # create other useful users
-        self.orgadmin = self.create_user(self.instance_config['email_orgadmin'], 2)
-        self.user = self.create_user(self.instance_config['email_user'], 3)
-        # And connectors
-        self.org_admin_connector = PyMISP(self.baseurl, self.orgadmin.authkey, ssl=self.secure_connection, debug=False)
-        self.org_admin_connector.toggle_global_pythonify()
-        self.user_connector = PyMISP(self.baseurl, self.user.authkey, ssl=self.secure_connection, debug=False)
-        self.user_connector.toggle_global_pythonify()
-
-    def __repr__(self):
-        return f'<{self.__class__.__name__}(external={self.baseurl})>'
+        self._record_user(self.host_site_admin)
+
+        self.site_admin_connector = self.connector(self.host_site_admin.authkey, 'site_admin')
+
+    def _set_server_setting(self, setting: str, value, force: bool=False):
+        if self.state['settings'].get(setting) == value:
+            return
+        self.site_admin_connector.set_server_setting(setting, value, force=force)
+        self._update_state('settings', setting, value)
+
+    def connector(self, authkey: str, role: str) -> PyMISP:
+        '''New connector to that instance, using the connection pool of the instance.
+        The requests are recorded in api_metrics, role is the kind of user (site_admin, org_admin, ...).'''
+        connector = PooledPyMISP(self.baseurl, authkey, self.connection_pool, metrics=api_metrics,
+                                 instance=self.directory_name, role=role, ssl=self.secure_connection, debug=False)
+        connector.toggle_global_pythonify()
+        return connector
+
+    def wait_for_event(self, connector: PyMISP, event: Union[MISPEvent, str], attributes: Optional[int]=None,
+                       objects: Optional[int]=None, timeout: int=propagation_timeout) -> MISPEvent:
+        '''Wait until the event is visible by the connector (one of the connectors of this instance),
+        with the expected number of attributes and objects, if given.'''
+        event_uuid = event.uuid if isinstance(event, MISPEvent) else event
+        start = time.time()
+        delay = 0.5
+        while True:
+            found = connector.get_event(event_uuid)
+            if (isinstance(found, MISPEvent)
+                    and (attributes is None or len(found.attributes) == attributes)
+                    and (objects is None or len(found.objects) == objects)):
+                self.propagation_delays[event_uuid] = time.time() - start
+                print(f'{self.name}: event {event_uuid} visible after {self.propagation_delays[event_uuid]:.1f}s')
+                return found
+            remaining = start + timeout - time.time()
+            if remaining <= 0:
+                raise Exception(f'{self.name}: event {event_uuid} not visible after {timeout}s, last response: {found}')
+            time.sleep(min(delay, remaining))
+            delay = min(delay * 1.5, 5)
+
+    def workers_status(self) -> Dict[str, bool]:
+        '''Queue name -> True if the workers of that queue are running, for all the queues reported by MISP'''
+        try:
+            settings = self.site_admin_connector.server_settings()
+            return {queue: bool(status['ok']) for queue, status in settings['workers'].items()
+                    if isinstance(status, dict) and 'ok' in status}
+        except Exception as e:
+            print(f'{self.name}: unable to get the workers status: {e}')
+            return {'server_settings': False}
+
+    def _fetch_all(self, kind: str, connector: PyMISP) -> List[AbstractMISP]:
+        if kind == 'organisations':
+            return connector.organisations(scope='all')
+        return getattr(connector, kind)()
+
+    def _lookup(self, kind: str, key: str, connector: Optional[PyMISP]=None, refresh_on_miss: bool=False) -> Optional[AbstractMISP]:
+        '''Find an object in the index, the first lookup of a kind fetches all the objects of that kind.
+        Use refresh_on_miss when the object is known to exist (typically, after a failed add): it is the only way the
+        index is fetched again, the objects created or updated through this instance are added by _remember.'''
+        if connector is None:
+            connector = self.site_admin_connector
+        with self._index_lock:
+            if kind in self._index and (key in self._index[kind] or not refresh_on_miss):
+                return self._index[kind].get(key)
+        # Fetched without the lock, the other threads keep using the index meanwhile
+        fetched = {getattr(obj, self.index_keys[kind]): obj for obj in self._fetch_all(kind, connector)}
+        with self._index_lock:
+            # What was created or updated meanwhile (or before) isn't lost
+            self._index[kind] = {**fetched, **self._remembered.get(kind, {})}
+            return self._index[kind].get(key)
+
+    def _remember(self, kind: str, obj: AbstractMISP):
+        '''Keep the index up to date with the result of a create/update call'''
+        if not isinstance(obj, AbstractMISP):
+            # Error response, nothing to put in the index
+            raise Exception(f'{self.name}: unable to save the {kind}: {obj}')
+        key = getattr(obj, self.index_keys[kind])
+        with self._index_lock:
+            self._remembered.setdefault(kind, {})[key] = obj
+            if kind in self._index:
+                self._index[kind][key] = obj
 
     def create_user(self, email, role_id):
+        known_user = self._known_user(email)
+        if known_user:
+            return known_user
         user = MISPUser()
         user.email = email
         user.org_id = self.host_org.id
         user.role_id = role_id
         new_user = self.site_admin_connector.add_user(user)
-        if not isinstance(new_user, MISPUser):
-            users = self.site_admin_connector.users()
-            for user in users:
-                if user.email == email:
-                    new_user = user
-                    break
-            else:
+        if isinstance(new_user, MISPUser):
+            self._remember('users', new_user)
+        else:
+            new_user = self._lookup('users', email, refresh_on_miss=True)
+            if not new_user:
                 raise Exception('Unable to find admin user')
+        self._record_user(new_user)
         return new_user
 
     def create_sync_user(self, organisation: MISPOrganisation) -> MISPServer:
+        short_org_name = organisation.name.lower().replace(' ', '-')
+        email = f"sync_user@{short_org_name}.local"
+        if organisation.name in self.state['sync_configs'] and self._known_user(email):
+            # Already done in a previous run, and the sync user is still there
+            sync_config = MISPServer()
+            sync_config.from_dict(**self.state['sync_configs'][organisation.name])
+            return sync_config
+
         sync_org = self.site_admin_connector.add_organisation(organisation)
-        if not isinstance(sync_org, MISPOrganisation):
+        if isinstance(sync_org, MISPOrganisation):
+            self._remember('organisations', sync_org)
+        else:
             # The organisation is probably already there
-            organisations = self.site_admin_connector.organisations(scope='all')
-            for org in organisations:
-                if org.name == organisation.name:
-                    if not org.local:
-                        org.local = True
-                        org = self.site_admin_connector.update_organisation(org)
-                    sync_org = org
-                    break
-            else:
+            sync_org = self._lookup('organisations', organisation.name, refresh_on_miss=True)
+            if not sync_org:
                 raise Exception('Unable to find sync organisation')
+            if not sync_org.local:
+                sync_org.local = True
+                sync_org = self.site_admin_connector.update_organisation(sync_org)
+                self._remember('organisations', sync_org)
 
-        short_org_name = sync_org.name.lower().replace(' ', '-')
-        email = f"sync_user@{short_org_name}.local"
         user = MISPUser()
         user.email = email
         user.org_id = sync_org.id
         user.role_id = 5  # Sync user
         sync_user = self.site_admin_connector.add_user(user)
-        if not isinstance(sync_user, MISPUser):
-            users = self.site_admin_connector.users()
-            for user in users:
-                if user.email == email:
-                    sync_user = user
-                    break
-            else:
+        if isinstance(sync_user, MISPUser):
+            self._remember('users', sync_user)
+        else:
+            sync_user = self._lookup('users', email, refresh_on_miss=True)
+            if not sync_user:
                 raise Exception('Unable to find sync user')
+        self._record_user(sync_user)
 
-        sync_user_connector = PyMISP(self.site_admin_connector.root_url, sync_user.authkey, ssl=self.secure_connection, debug=False)
-        return sync_user_connector.get_sync_config(pythonify=True)
+        sync_user_connector = self.connector(sync_user.authkey, 'sync_user')
+        sync_config = sync_user_connector.get_sync_config(pythonify=True)
+        if not isinstance(sync_config, MISPServer):
+            raise Exception(f'Unable to get the sync config: {sync_config}')
+        self._update_state('sync_configs', organisation.name, sync_config.to_dict())
+        return sync_config
 
-    def configure_sync(self, server_sync_config: MISPServer):
+    def configure_sync(self, server_sync_config: MISPServer, push: bool=False, pull: bool=True):
         # Add sharing server
-        for s in self.site_admin_connector.servers():
-            if s.name == server_sync_config.name:
-                server = s
-                break
-        else:
+        server = self._lookup('servers', server_sync_config.name)
+        known_server = self.state['servers'].get(server_sync_config.name)
+        if (server and known_server and known_server['id'] == server.id and known_server['tested']
+                and known_server.get('push') == push and known_server.get('pull') == pull
+                and bool(server.pull) == pull and bool(server.push) == push
+                and getattr(server, 'authkey', server_sync_config.authkey) == server_sync_config.authkey):
+            # Already configured and tested in a previous run
+            self.synchronisations[server_sync_config.name.replace('Sync with ', '')] = server
+            return
+        if not server:
             server = self.site_admin_connector.import_server(server_sync_config)
-        server.pull = True
-        server.push = False
+        server.pull = pull
+        server.push = push
         server = self.site_admin_connector.update_server(server)
-        r = self.site_admin_connector.test_server(server)
+        self._remember('servers', server)
+        with tracer.span('test_server', self.directory_name, server=server_sync_config.name):
+            r = self.site_admin_connector.test_server(server)
         if r['status'] != 1:
             raise Exception(f'Sync test failed: {r}')
         print(server)
         print(server.to_json(indent=2))
+        self._update_state('servers', server_sync_config.name, {'id': server.id, 'tested': True, 'push': push, 'pull': pull})
         # NOTE: this is dirty.
         self.synchronisations[server_sync_config.name.replace('Sync with ', '')] = server
 
@@ -160,12 +380,11 @@ class MISPInstance():
         tag.exportable = False
         tag.org_id = self.host_org.id
         tag = self.site_admin_connector.add_tag(tag)
-        if not isinstance(tag, MISPTag):
-            for t in self.site_admin_connector.tags():
-                if t.name == name:
-                    tag = t
-                    break
-            else:
+        if isinstance(tag, MISPTag):
+            self._remember('tags', tag)
+        else:
+            tag = self._lookup('tags', name, refresh_on_miss=True)
+            if not tag:
                 raise Exception('Unable to find tag')
 
         # Set limit on sync config
@@ -174,20 +393,21 @@ class MISPInstance():
         server_sync.push_rules = json.dumps(filter_tag_push)
         # server.pull_rules = json.dumps(filter_tag_pull)
         server_sync = self.site_admin_connector.update_server(server_sync)
+        self._remember('servers', server_sync)
 
     def add_sharing_group(self, name: str, releasibility: str='Whatever it is a test',
                           servers: List[MISPServer]=[], organisations: List[MISPOrganisation]=[]):
 
         # Add sharing group
-        for sg in self.site_admin_connector.sharing_groups():
-            if sg.name == name:
-                self.sharing_group = sg
-                break
+        sg = self._lookup('sharing_groups', name)
+        if sg:
+            self.sharing_group = sg
         else:
             sharing_group = MISPSharingGroup()
             sharing_group.name = name
             sharing_group.releasability = releasibility
             self.sharing_group = self.site_admin_connector.add_sharing_group(sharing_group)
+            self._remember('sharing_groups', self.sharing_group)
             for server in servers:
                 self.site_admin_connector.add_server_to_sharing_group(self.sharing_group, server)
             for organisation in organisations:
@@ -200,63 +420,224 @@ class MISPInstances():
     prefix_client_node = prefix_client_node
     secure_connection = secure_connection
 
-    def __init__(self, root_misps: str='misps'):
+    def __init__(self, root_misps: str='misps', topology: str=sync_topology, number_instances: Optional[int]=None,
+                 edges_file: Optional[Path]=None, read_only: bool=False):
+        '''number_instances: only use the first N client instances (default: all the ones in root_misps)
+        edges_file: JSON list of links, overwrites the topology (see topology.from_edges_file)
+        read_only: use the instances, the users and the sync links set up by the last ./setup_sync.py as they are
+        (number_instances, topology and edges_file are ignored), nothing is created or changed. The push/pull flags
+        are only changed by the tests, on the instances they leased.'''
         self.misp_instances_dir = Path(root_misps)
-
-        self.central_node = MISPInstance(self.misp_instances_dir / self.central_node_name, self.secure_connection)
-
-        self.instances = []
-
-        # Initialize all instances to sync with central node
-        for path in sorted(self.misp_instances_dir.glob(f'{self.prefix_client_node}*')):
-            if path.name == self.central_node_name:
-                continue
-            instance = MISPInstance(path, self.secure_connection)
-            sync_server_config = self.central_node.create_sync_user(instance.host_org)
-            print(sync_server_config.to_json())
-            sync_server_config.name = f'Sync with {sync_server_config.Organisation["name"]}'
-            instance.configure_sync(sync_server_config)
-            self.instances.append(instance)
-
-        # Create sync links for the instances among themselves.
-        for instance_dest in self.instances:
-            for instance_source in self.instances:
-                if instance_dest == instance_source:
-                    continue
-                sync_server_config = instance_dest.create_sync_user(instance_source.host_org)
-                sync_server_config.name = f'Sync with {sync_server_config.Organisation["name"]}'
-                instance_source.configure_sync(sync_server_config)
-
-    def dump_all_auth(self):
-        auth = []
-        for instance in self.instances + [self.central_node]:
-            for user in instance.site_admin_connector.users():
-                if user.change_pw == '1':
-                    # Only change the password if the user never logged in.
-                    password = ''.join(random.choices(string.ascii_uppercase + string.digits, k=16))
-                    instance.site_admin_connector.change_user_password(password, user)
-                else:
-                    password = 'Already changed by the user'
-                a = {'url': instance.baseurl, 'login': user.email, 'authkey': user.authkey,
-                     'password': password}
-                auth.append(a)
-
-        with (self.misp_instances_dir / 'auth.json').open('w') as f:
-            json.dump(auth, f, indent=2)
-
-        with (self.misp_instances_dir / 'auth.csv').open('w') as csvfile:
-            fieldnames = ['url', 'login', 'authkey', 'password']
-            writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-
+        # Client instances configured by the last ./setup_sync.py (it may have only used some of them, see --instances)
+        self.setup_file = self.misp_instances_dir / 'sync_setup.json'
+
+        if read_only:
+            if not self.setup_file.exists():
+                raise Exception('The sync is not set up, run ./setup_sync.py first')
+            with self.setup_file.open() as f:
+                clients = [self.misp_instances_dir / name for name in json.load(f)['instances']]
+        else:
+            # Numeric order (misp-2 before misp-10): the first N instances are the same whatever N
+            clients = sorted((path for path in self.misp_instances_dir.glob(f'{self.prefix_client_node}*')
+                              if path.name != self.central_node_name), key=lambda path: (len(path.name), path.name))
+            if number_instances is not None:
+                clients = clients[:number_instances]
+        paths = [self.misp_instances_dir / self.central_node_name] + clients
+        with ThreadPoolExecutor(max_workers=len(paths)) as executor:
+            instances = list(executor.map(lambda path: MISPInstance(path, self.secure_connection, read_only), paths))
+        self.central_node = instances[0]
+        self.instances = instances[1:]
+
+        if read_only:
+            self.links = self._known_links()
+            return
+        # NOTE: all the host organisations exist at this point, they can be used as sync organisations.
+        self.links = sync_links(topology, self.central_node.directory_name, [i.directory_name for i in self.instances],
+                                edges_file, sync_tree_fanout)
+        self.create_sync_links(self.links)
+        self._record_setup()
+
+    @property
+    def by_directory_name(self) -> Dict[str, MISPInstance]:
+        return {instance.directory_name: instance for instance in [self.central_node] + self.instances}
+
+    def _known_links(self) -> List[SyncLink]:
+        '''The sync links loaded from the state of the instances (see MISPInstance._load_setup)'''
+        all_instances = [self.central_node] + self.instances
+        by_name = {instance.name: instance for instance in all_instances}
+        return [SyncLink(source.directory_name, by_name[name].directory_name, *source.configured_sync(name))
+                for source in all_instances for name in source.synchronisations if name in by_name]
+
+    def _record_setup(self):
+        '''Written and renamed: the tests may be loading it at the same time'''
+        tmp_file = self.setup_file.with_name(f'{self.setup_file.name}.{os.getpid()}.tmp')
+        with tmp_file.open('w') as f:
+            json.dump({'instances': [instance.directory_name for instance in self.instances]}, f, indent=2)
+        tmp_file.replace(self.setup_file)
+
+    def create_sync_links(self, links: List[SyncLink]):
+        '''Create all the sync links concurrently.
+        The number of concurrent requests on each instance is limited by MISPInstance.request_slots.'''
+        instances = self.by_directory_name
+        errors = []
+        with ThreadPoolExecutor(max_workers=len(instances) * max_requests_per_instance) as executor:
+            futures = {executor.submit(self.create_sync_link, instances[link.dest], instances[link.source], link.push, link.pull): link
+                       for link in links}
+            for future, link in futures.items():
+                try:
+                    future.result()
+                except Exception as e:
+                    errors.append(f'{link.source} -> {link.dest}: {e}')
+        if errors:
+            raise Exception('Unable to create sync links:\n' + '\n'.join(errors))
+
+    @staticmethod
+    def create_sync_link(instance_dest: MISPInstance, instance_source: MISPInstance, push: bool=False, pull: bool=True):
+        '''The source instance gets a server pointing to the destination instance.'''
+        with instance_dest.request_slots, tracer.span('sync user', instance_dest.directory_name, org=instance_source.name):
+            sync_server_config = instance_dest.create_sync_user(instance_source.host_org)
+        sync_server_config.name = f'Sync with {sync_server_config.Organisation["name"]}'
+        with instance_source.request_slots, tracer.span('configure sync', instance_source.directory_name,
+                                                        server=sync_server_config.name):
+            instance_source.configure_sync(sync_server_config, push, pull)
+
+    def wait_for_workers(self, timeout: int=workers_timeout, ignore_queues: Iterable[str]=()):
+        '''Wait until the workers of all the queues are running on all the instances (central node included).'''
+        all_instances = [self.central_node] + self.instances
+        start = time.time()
+        previous_table = ''
+        with ThreadPoolExecutor(max_workers=len(all_instances)) as executor, tracer.span('wait for workers'):
+            while True:
+                statuses = dict(zip([i.name for i in all_instances], executor.map(MISPInstance.workers_status, all_instances)))
+                for status in statuses.values():
+                    for queue in ignore_queues:
+                        status.pop(queue, None)
+                ready = all(all(status.values()) for status in statuses.values())
+                table = self._workers_table(statuses)
+                if ready:
+                    print(f'All workers are ready ({time.time() - start:.0f}s).')
+                    return
+                if time.time() - start > timeout:
+                    raise Exception(f'Workers not ready after {timeout}s:\n{table}')
+                if table != previous_table:
+                    print(table)
+                    previous_table = table
+                time.sleep(1)
+
+    @staticmethod
+    def _workers_table(statuses: Dict[str, Dict[str, bool]]) -> str:
+        queues = sorted({queue for status in statuses.values() for queue in status})
+        name_width = max(len(name) for name in statuses)
+        lines = [' '.join([''.ljust(name_width)] + queues)]
+        for name, status in statuses.items():
+            cells = []
+            for queue in queues:
+                cell = 'ok' if status.get(queue) else ('--' if queue not in status else 'DOWN')
+                cells.append(cell.ljust(len(queue)))
+            lines.append(' '.join([name.ljust(name_width)] + cells).rstrip())
+        return '\n'.join(lines)
+
+    @staticmethod
+    def _user_auth(instance: MISPInstance, user: MISPUser) -> Dict[str, str]:
+        with instance.request_slots:
+            if user.change_pw == '1':
+                # Only change the password if the user never logged in.
+                # NOTE: PyMISP.change_user_password changes the password of the connector user, not the one of *user*
+                password = ''.join(random.choices(string.ascii_uppercase + string.digits, k=16))
+                user.password = password
+                updated = instance.site_admin_connector.update_user(user)
+                if not isinstance(updated, MISPUser):
+                    raise Exception(f'{instance.name}: unable to set the password of {user.email}: {updated}')
+            else:
+                password = 'Already changed by the user'
+        return {'url': instance.baseurl, 'login': user.email, 'authkey': user.authkey, 'password': password}
+
+    def dump_all_auth(self, incremental: bool=False):
+        '''Write the credentials of all the users of all the instances in auth.json and auth.csv.
+        The instances are processed at the same time, each user is written as soon as it is done.
+        incremental: the users already in auth.json are kept as they are if they still exist with the same authkey
+        (not the ones of a wiped and re-initialized instance), only the other ones are added.
+        A failing user doesn't stop the other ones, the passwords already changed are always written.'''
+        json_file = self.misp_instances_dir / 'auth.json'
+        csv_file = self.misp_instances_dir / 'auth.csv'
+        fieldnames = ['url', 'login', 'authkey', 'password']
+        previous: List[Dict[str, str]] = []
+        if incremental and json_file.exists():
+            with json_file.open() as f:
+                previous = json.load(f)
+
+        all_instances = self.instances + [self.central_node]
+        with ThreadPoolExecutor(max_workers=len(all_instances)) as executor:
+            users = dict(zip(all_instances, executor.map(lambda i: i.site_admin_connector.users(), all_instances)))
+        current = {(instance.baseurl, user.email): user.authkey for instance in all_instances for user in users[instance]}
+        urls = {instance.baseurl for instance in all_instances}
+        # The users gone from the instances of this run are dropped, the instances not in this run are kept as they are
+        previous = [a for a in previous if a['url'] not in urls or current.get((a['url'], a['login'])) == a['authkey']]
+        known = {(a['url'], a['login']) for a in previous}
+
+        failures: List[str] = []
+        # The CSV file is rewritten: the previous entries may have been dropped
+        with json_file.open('w') as f_json, csv_file.open('w') as f_csv:
+            writer = csv.DictWriter(f_csv, fieldnames=fieldnames)
             writer.writeheader()
-            for a in auth:
+            # Streamed JSON list: the previous entries first, then the new ones as they come
+            f_json.write('[')
+            separator = '\n  '
+            for a in previous:
+                f_json.write(separator + json.dumps(a))
+                separator = ',\n  '
                 writer.writerow(a)
+            try:
+                with ThreadPoolExecutor(max_workers=len(all_instances) * max_requests_per_instance) as executor:
+                    futures = {executor.submit(self._user_auth, instance, user): (instance, user)
+                               for instance in all_instances for user in users[instance]
+                               if (instance.baseurl, user.email) not in known}
+                    for future in as_completed(futures):
+                        instance, user = futures[future]
+                        try:
+                            a = future.result()
+                        except Exception as e:
+                            failures.append(f'{instance.name} - {user.email}: {e}')
+                            continue
+                        f_json.write(separator + json.dumps(a))
+                        separator = ',\n  '
+                        writer.writerow(a)
+                        f_csv.flush()
+            finally:
+                # Valid JSON with the users done so far
+                f_json.write('\n]\n')
+        if failures:
+            raise Exception('Unable to get the credentials of some users:\n' + '\n'.join(failures))
+
+
+def take_snapshot(misp_instances_dir: Path):
+    '''./snapshot_misps.py take, a separate script: it uses the docker API and not MISP'''
+    subprocess.run([sys.executable, str(Path(__file__).resolve().parent / 'snapshot_misps.py'), 'take',
+                    '--misps', str(misp_instances_dir.resolve())], check=True)
 
 
 if __name__ == '__main__':
-    instances = MISPInstances()
-    instances.dump_all_auth()
+    parser = argparse.ArgumentParser(description='Configure the users and the synchronisation of the MISP instances.')
+    parser.add_argument('--topology', default=sync_topology, help='star, full_mesh, chain, ring or tree.')
+    parser.add_argument('--instances', type=int, help='Only use the first N client instances.')
+    parser.add_argument('--edges', type=Path, help='JSON file with the list of sync links, overwrites --topology.')
+    parser.add_argument('--incremental', action='store_true',
+                        help='Keep the users already in auth.json (and their password), only add the new ones.')
+    parser.add_argument('--snapshot', action='store_true',
+                        help='Snapshot the data of the instances once the sync is set up (restore: ./snapshot_misps.py restore).')
+    args = parser.parse_args()
+
+    instances = MISPInstances(topology=args.topology, number_instances=args.instances, edges_file=args.edges)
+    instances.dump_all_auth(args.incremental)
     with (instances.misp_instances_dir / 'auth.json').open() as f:
         print(f.read())
     with (instances.misp_instances_dir / 'auth.csv').open() as f:
         print(f.read())
+    trace_file = instances.misp_instances_dir / 'logs' / 'setup_sync-trace.json'
+    tracer.dump(trace_file)
+    print(tracer.summary())
+    print(f'Trace (chrome://tracing or https://ui.perfetto.dev): {trace_file}')
+    api_metrics.dump(instances.misp_instances_dir / 'logs' / 'setup_sync-api-metrics.json')
+    print(api_metrics.report())
+    if args.snapshot:
+        take_snapshot(instances.misp_instances_dir)
@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import argparse
+import shutil
+import time
+from pathlib import Path
+import yaml
+
+from typing import List, Tuple
+
+from generic_config import teardown_workers, shared_backends_name
+from docker_control import DockerControl, run_parallel, print_summary
+from init_misps import known_instances
+from federation import instance_compose
+
+# Services with the data of an instance: the database and the redis data (queues of the workers)
+snapshot_services = ('db', 'redis')
+
+
+def data_volumes(docker_control: DockerControl, misp_dir: Path) -> List[Tuple[str, str]]:
+    '''(volume, image of the service using it) for all the data volumes of the instance'''
+    with (misp_dir / 'docker-compose.yml').open() as f:
+        services = yaml.safe_load(f.read())['services']
+    volumes = []
+    # The instances using the shared backends have no db and redis services
+    for service in [service for service in snapshot_services if service in services]:
+        container = docker_control.container(misp_dir, service, stopped=True)
+        volumes += [(mount['Name'], container.image.id) for mount in container.attrs['Mounts'] if mount['Type'] == 'volume']
+    return volumes
+
+
+def snapshot_volume(volume: str) -> str:
+    return f'{volume}-snapshot'
+
+
+def copy_data(docker_control: DockerControl, misp_dir: Path, restore: bool, log_file: Path) -> float:
+    '''Copy the data volumes of an instance to their snapshot (or back, if *restore*), the instance is stopped meanwhile.
+    The sync state (see setup_sync.py) is part of the snapshot, it describes what is in the database.'''
+    start = time.time()
+    log_file.write_text('')
+    volumes = data_volumes(docker_control, misp_dir)
+    if restore:
+        missing = [volume for volume, image in volumes if not docker_control.volume_exists(snapshot_volume(volume))]
+        if missing:
+            raise Exception(f'{misp_dir.name}: no snapshot of {", ".join(missing)}')
+    state_file = misp_dir / 'sync_state.json'
+    state_snapshot = misp_dir / 'sync_state.snapshot.json'
+
+    instance_compose(docker_control, misp_dir, 'stop', log_file=log_file)
+    try:
+        for volume, image in volumes:
+            if restore:
+                docker_control.copy_volume(snapshot_volume(volume), volume, image)
+            else:
+                docker_control.copy_volume(volume, snapshot_volume(volume), image)
+        if restore and state_snapshot.exists():
+            shutil.copy(str(state_snapshot), str(state_file))
+        elif not restore and state_file.exists():
+            shutil.copy(str(state_file), str(state_snapshot))
+    finally:
+        instance_compose(docker_control, misp_dir, 'start', log_file=log_file)
+    return time.time() - start
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Snapshot the data of all the MISP instances, or restore it.')
+    parser.add_argument('action', choices=['take', 'restore'])
+    parser.add_argument('--misps', type=Path, default=Path('misps'), help='Directory of the instances.')
+    parser.add_argument('--workers', type=int, default=teardown_workers, help='Number of instances processed at the same time.')
+    args = parser.parse_args()
+
+    docker_control = DockerControl()
+    logs_dir = args.misps / 'logs'
+    logs_dir.mkdir(exist_ok=True)
+    misp_dirs = [path for path in known_instances(args.misps) + [args.misps / shared_backends_name] if path.exists()]
+    restore = args.action == 'restore'
+
+    durations, failures = run_parallel(
+        lambda misp_dir: copy_data(docker_control, misp_dir, restore, logs_dir / f'{misp_dir.name}-snapshot.log'),
+        misp_dirs, args.workers)
+    print_summary([misp_dir.name for misp_dir in misp_dirs], durations, failures, title=f'Summary ({args.action})')
+    if restore and not failures:
+        print('The background workers need a moment to be back (see MISPInstances.wait_for_workers).')
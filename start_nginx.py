@@ -1,23 +1,15 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
-import os
-from subprocess import Popen
-import shlex
 from pathlib import Path
 import time
+from docker_control import DockerControl
 
 nginx_root = Path('nginx-proxy')
-cur_dir = os.getcwd()
-os.chdir(nginx_root)
-command = shlex.split('sudo docker-compose up -d')
-p = Popen(command)
-p.wait()
+docker_control = DockerControl()
+docker_control.compose(nginx_root, 'up -d')
 time.sleep(5)
-command = shlex.split('sudo docker exec nginx-proxy /bin/cat /etc/nginx/conf.d/default.conf')
-p = Popen(command)
-p.wait()
-command = shlex.split('sudo docker exec nginx-proxy /bin/cat /etc/nginx/network_internal.conf')
-p = Popen(command)
-p.wait()
-os.chdir(cur_dir)
+nginx = docker_control.container_by_name('nginx-proxy')
+for config_file in ('/etc/nginx/conf.d/default.conf', '/etc/nginx/network_internal.conf'):
+    exit_code, output = docker_control.exec(nginx, ['/bin/cat', config_file])
+    print(output)
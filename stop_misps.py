@@ -1,17 +1,89 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
-import os
-from subprocess import Popen
-import shlex
+import argparse
+import json
+import time
 from pathlib import Path
 
+from generic_config import internal_network_name, teardown_workers, shared_backends_name
+from docker_control import DockerControl, compose_project_name, run_parallel, print_summary
+from init_misps import known_instances
+from federation import Federation
+
 misps_root = Path('misps')
+nginx_root = Path('nginx-proxy')
+
+# stop: the containers are kept, down: the containers are removed (not the data),
+# wipe: the containers, the volumes (databases) and the internal network are removed
+compose_arguments = {'stop': 'stop', 'down': 'down --remove-orphans', 'wipe': 'down --volumes --remove-orphans'}
+
+
+def forget_bootstrap(misp_dir: Path):
+    '''The databases are gone, the bootstrap and the sync setup have to be done again'''
+    config_file = misp_dir / 'config.json'
+    # NOTE: the config of the shared backends has no bootstrap
+    if config_file.exists() and misp_dir.name != shared_backends_name:
+        with config_file.open() as f:
+            config = json.load(f)
+        config['bootstrap'] = {}
+        for key in ('external_baseurl', 'cloned_from', 'misp_uuid', 'org_uuid'):
+            config.pop(key, None)
+        with config_file.open('w') as f:
+            json.dump(config, f, indent=2)
+    for state_file in (misp_dir / 'sync_state.json', misp_dir / 'sync_state.snapshot.json'):
+        if state_file.exists():
+            state_file.unlink()
+
+
+def teardown(docker_control: DockerControl, project_dir: Path, mode: str, log_file: Path, compose: bool=True) -> float:
+    '''compose: False if the containers of the project are part of the federation (stopped all at once)'''
+    start = time.time()
+    log_file.write_text('')
+    if compose:
+        docker_control.compose(project_dir, compose_arguments[mode], log_file=log_file)
+    if mode == 'wipe':
+        forget_bootstrap(project_dir)
+        # Made by snapshot_misps.py and init_misps.py --from-template, docker-compose doesn't know about them
+        for suffix in ('-snapshot', '-template'):
+            docker_control.remove_volumes(f'{compose_project_name(project_dir)}_', suffix)
+    return time.time() - start
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Stop all the MISP instances and the nginx proxy.')
+    parser.add_argument('mode', nargs='?', choices=list(compose_arguments), default='stop',
+                        help='stop (default), down (remove the containers, keep the data) or wipe (remove everything).')
+    parser.add_argument('--workers', type=int, default=teardown_workers, help='Number of instances stopped at the same time.')
+    args = parser.parse_args()
+
+    docker_control = DockerControl()
+    logs_dir = misps_root / 'logs'
+    logs_dir.mkdir(parents=True, exist_ok=True)
+    projects = [path for path in known_instances(misps_root) if path.exists()]
+    if not projects:
+        print(f'No instance listed in {misps_root / "instances.json"}, run init_misps.py first.')
+    if (misps_root / shared_backends_name).exists():
+        projects.append(misps_root / shared_backends_name)
+    if nginx_root.exists():
+        projects.append(nginx_root)
+    # The instances and the nginx proxy started by init_misps.py --federation: one docker-compose call for all of them
+    federation = Federation(misps_root)
+    federated = set(federation.services) if federation.enabled else set()
+    if federation.enabled:
+        projects.append(federation.project_dir)
+
+    durations, failures = run_parallel(
+        lambda project_dir: teardown(docker_control, project_dir, args.mode, logs_dir / f'{project_dir.name}-{args.mode}.log',
+                                     project_dir.name not in federated),
+        projects, args.workers, done=f'{args.mode} done')
+
+    if args.mode == 'wipe':
+        if failures:
+            print(f'Not removing the network {internal_network_name}, some instances may still use it.')
+        else:
+            docker_control.remove_network(internal_network_name)
+            print(f'Network {internal_network_name} removed.')
 
-for misp_dir in misps_root.glob('misp*'):
-    cur_dir = os.getcwd()
-    os.chdir(misp_dir)
-    command = shlex.split('sudo docker-compose stop')
-    p = Popen(command)
-    p.wait()
-    os.chdir(cur_dir)
+    print_summary([project_dir.name for project_dir in projects], durations, failures,
+                  details=lambda name: f' - log: {logs_dir / f"{name}-{args.mode}.log"}')
@@ -1,15 +1,8 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
-import os
-from subprocess import Popen
-import shlex
 from pathlib import Path
+from docker_control import DockerControl
 
 nginx_root = Path('nginx-proxy')
-cur_dir = os.getcwd()
-os.chdir(nginx_root)
-command = shlex.split('sudo docker-compose stop')
-p = Popen(command)
-p.wait()
-os.chdir(cur_dir)
+DockerControl().compose(nginx_root, 'stop')
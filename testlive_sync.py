@@ -1,8 +1,10 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
-import time
+import os
+import random
 import unittest
+import uuid
 
 import urllib3  # type: ignore
 import logging
@@ -10,6 +12,10 @@ import logging
 from pymisp import MISPEvent, MISPObject, MISPSharingGroup, Distribution
 
 from .setup_sync import MISPInstances
+from .instance_leases import InstanceLeases
+from .propagation import PropagationTrace
+from .generic_config import trace_propagation
+from .api_metrics import api_metrics
 
 logging.disable(logging.CRITICAL)
 urllib3.disable_warnings()
@@ -17,21 +23,54 @@ urllib3.disable_warnings()
 
 class TestSync(unittest.TestCase):
 
+    # Each test leases its own instances, they can run in parallel: nosetests --processes=N
+    _multiprocess_can_split_ = True
+
     @classmethod
     def setUpClass(cls):
         cls.maxDiff = None
-        cls.misp_instances = MISPInstances()
-
-        ready = False
-        while not ready:
-            ready = True
-            for i in cls.misp_instances.instances:
-                settings = i.site_admin_connector.server_settings()
-                if (not settings['workers']['default']['ok']
-                        or not settings['workers']['prio']['ok']):
-                    print(f'Not ready: {i}')
-                    ready = False
-            time.sleep(1)
+        # Set up once by ./setup_sync.py: the tests running in other processes rely on the push/pull flags of their links
+        cls.misp_instances = MISPInstances(read_only=True)
+        cls.misp_instances.wait_for_workers()
+        cls.leases = InstanceLeases(cls.misp_instances.misp_instances_dir / 'locks', cls.misp_instances.instances)
+        # Only the calls made by the tests
+        api_metrics.reset()
+
+    @classmethod
+    def tearDownClass(cls):
+        # One file per process (nosetests --processes=N)
+        api_metrics.dump(cls.misp_instances.misp_instances_dir / 'logs' / f'testsync-api-metrics-{os.getpid()}.json')
+        print(api_metrics.report())
+
+    def setUp(self):
+        # Unique per test run, so the events of the tests running in parallel can't be mixed up
+        self.namespace = f'{self._testMethodName} - {uuid.uuid4()}'
+
+    def lease_instances(self, count: int):
+        '''Instances only used by this test until it ends, each one has sync links with the next one'''
+        lease = self.leases.acquire(count)
+        self.addCleanup(lease.release)
+        return lease.instances
+
+    def enable_push(self, source, dest):
+        '''Automatic push from source to dest (both leased by the test), set back as ./setup_sync.py configured it
+        when the test ends'''
+        server = source.synchronisations[dest.name]
+        push, _ = source.configured_sync(dest.name)
+        self.addCleanup(source.site_admin_connector.update_server, {'push': push}, server.id)
+        return source.site_admin_connector.update_server({'push': True}, server.id)
+
+    def trace(self, event, source, downstream):
+        '''Propagation trace of the event if trace_propagation is set, stopped when the test ends'''
+        if not trace_propagation:
+            return None
+        trace = PropagationTrace(event, source, downstream)
+        self.addCleanup(trace.stop)
+        return trace
+
+    @staticmethod
+    def random_ip() -> str:
+        return '.'.join(str(random.randint(1, 254)) for _ in range(4))
 
     # @classmethod
     # def tearDownClass(cls):
@@ -41,81 +80,78 @@ class TestSync(unittest.TestCase):
     def test_simple_sync(self):
         '''Test simple event, push to one server'''
         event = MISPEvent()
-        event.info = 'Event created on first instance - test_simple_sync'
+        event.info = f'Event created on first instance - {self.namespace}'
         event.distribution = Distribution.all_communities
-        event.add_attribute('ip-src', '1.1.1.1')
+        event.add_attribute('ip-src', self.random_ip())
+        source, dest = self.lease_instances(2)
         try:
-            source = self.misp_instances.instances[0]
-            dest = self.misp_instances.instances[1]
             event = source.org_admin_connector.add_event(event)
             source.org_admin_connector.publish(event)
             source.site_admin_connector.server_push(source.synchronisations[dest.name], event)
-            time.sleep(10)
-            dest_event = dest.org_admin_connector.get_event(event.uuid)
+            dest_event = dest.wait_for_event(dest.org_admin_connector, event, attributes=1)
             self.assertEqual(event.attributes[0].value, dest_event.attributes[0].value)
 
         finally:
             source.org_admin_connector.delete_event(event)
-            dest.site_admin_connector.delete_event(dest_event)
+            dest.site_admin_connector.delete_event(event)
 
     def test_sync_community(self):
         '''Simple event, this community only, pull from member of the community'''
         event = MISPEvent()
-        event.info = 'Event created on first instance - test_sync_community'
+        event.info = f'Event created on first instance - {self.namespace}'
         event.distribution = Distribution.this_community_only
-        event.add_attribute('ip-src', '1.1.1.1')
+        event.add_attribute('ip-src', self.random_ip())
+        source, dest = self.lease_instances(2)
         try:
-            source = self.misp_instances.instances[0]
-            dest = self.misp_instances.instances[1]
             event = source.org_admin_connector.add_event(event)
             source.org_admin_connector.publish(event)
             dest.site_admin_connector.server_pull(dest.synchronisations[source.name])
-            time.sleep(10)
-            dest_event = dest.org_admin_connector.get_event(event)
+            dest_event = dest.wait_for_event(dest.org_admin_connector, event)
             self.assertEqual(dest_event.distribution, 0)
         finally:
             source.org_admin_connector.delete_event(event)
-            dest.site_admin_connector.delete_event(dest_event)
+            dest.site_admin_connector.delete_event(event)
 
     def test_sync_all_communities(self):
         '''Simple event, all communities, enable automatic push on two sub-instances'''
         event = MISPEvent()
-        event.info = 'Event created on first instance - test_sync_all_communities'
+        event.info = f'Event created on first instance - {self.namespace}'
         event.distribution = Distribution.all_communities
-        event.add_attribute('ip-src', '1.1.1.1')
+        event.add_attribute('ip-src', self.random_ip())
+        source, middle, last = self.lease_instances(3)
         try:
-            source = self.misp_instances.instances[0]
-            middle = self.misp_instances.instances[1]
-            last = self.misp_instances.instances[2]
-            server = source.site_admin_connector.update_server({'push': True}, source.synchronisations[middle.name].id)
+            server = self.enable_push(source, middle)
             self.assertTrue(server.push)
 
-            middle.site_admin_connector.update_server({'push': True}, middle.synchronisations[last.name].id)  # Enable automatic push to 3rd instance
+            self.enable_push(middle, last)  # Enable automatic push to 3rd instance
             event = source.user_connector.add_event(event)
+            trace = self.trace(event, source, [middle, last])
             source.org_admin_connector.publish(event)
+            if trace:
+                trace.published()
             source.site_admin_connector.server_push(source.synchronisations[middle.name])
-            time.sleep(30)
-            middle_event = middle.user_connector.get_event(event.uuid)
+            middle_event = middle.wait_for_event(middle.user_connector, event, attributes=1)
             self.assertEqual(event.attributes[0].value, middle_event.attributes[0].value)
-            last_event = last.user_connector.get_event(event.uuid)
+            last_event = last.wait_for_event(last.user_connector, event, attributes=1)
             self.assertEqual(event.attributes[0].value, last_event.attributes[0].value)
+            if trace:
+                trace.collect()
+                print(trace.timeline())
         finally:
             source.org_admin_connector.delete_event(event)
-            middle.site_admin_connector.delete_event(middle_event)
-            last.site_admin_connector.delete_event(last_event)
-            source.site_admin_connector.update_server({'push': False}, source.synchronisations[middle.name].id)
-            middle.site_admin_connector.update_server({'push': False}, middle.synchronisations[last.name].id)
+            middle.site_admin_connector.delete_event(event)
+            last.site_admin_connector.delete_event(event)
 
     def create_complex_event(self):
         event = MISPEvent()
-        event.info = 'Complex Event'
+        event.info = f'Complex Event - {self.namespace}'
         event.distribution = Distribution.all_communities
         event.add_tag('tlp:white')
 
-        event.add_attribute('ip-src', '8.8.8.8')
-        event.add_attribute('ip-dst', '8.8.8.9')
-        event.add_attribute('domain', 'google.com')
-        event.add_attribute('md5', '3c656da41f4645f77e3ec3281b63dd43')
+        event.add_attribute('ip-src', self.random_ip())
+        event.add_attribute('ip-dst', self.random_ip())
+        event.add_attribute('domain', f'{uuid.uuid4()}.example.com')
+        event.add_attribute('md5', uuid.uuid4().hex)
 
         event.attributes[0].distribution = Distribution.your_organisation_only
         event.attributes[1].distribution = Distribution.this_community_only
@@ -128,8 +164,8 @@ class TestSync(unittest.TestCase):
         obj = MISPObject('file')
 
         obj.distribution = Distribution.connected_communities
-        obj.add_attribute('filename', 'testfile')
-        obj.add_attribute('md5', '3c656da41f4645f77e3ec3281b63dd44')
+        obj.add_attribute('filename', f'testfile-{uuid.uuid4()}')
+        obj.add_attribute('md5', uuid.uuid4().hex)
         obj.attributes[0].distribution = Distribution.your_organisation_only
 
         event.add_object(obj)
@@ -139,18 +175,21 @@ class TestSync(unittest.TestCase):
     def test_complex_event_push_pull(self):
         '''Test automatic push'''
         event = self.create_complex_event()
+        source, middle, last = self.lease_instances(3)
         try:
-            source = self.misp_instances.instances[0]
-            middle = self.misp_instances.instances[1]
-            last = self.misp_instances.instances[2]
-            source.site_admin_connector.update_server({'push': True}, source.synchronisations[middle.name].id)
-            middle.site_admin_connector.update_server({'push': True}, middle.synchronisations[last.name].id)  # Enable automatic push to 3rd instance
+            self.enable_push(source, middle)
+            self.enable_push(middle, last)  # Enable automatic push to 3rd instance
 
             event = source.org_admin_connector.add_event(event)
+            trace = self.trace(event, source, [middle, last])
             source.org_admin_connector.publish(event)
-            time.sleep(15)
-            event_middle = middle.user_connector.get_event(event.uuid)
-            event_last = last.user_connector.get_event(event.uuid)
+            if trace:
+                trace.published()
+            event_middle = middle.wait_for_event(middle.user_connector, event, attributes=2, objects=1)
+            event_last = last.wait_for_event(last.user_connector, event, attributes=1, objects=0)
+            if trace:
+                trace.collect()
+                print(trace.timeline())
             self.assertEqual(len(event_middle.attributes), 2)  # attribute 3 and 4
             self.assertEqual(len(event_middle.objects[0].attributes), 1)  # attribute 2
             self.assertEqual(len(event_last.attributes), 1)  # attribute 4
@@ -178,27 +217,21 @@ class TestSync(unittest.TestCase):
             # self.assertEqual(len(event_last.attributes), 2)  # attribute 3 and 4
         finally:
             source.org_admin_connector.delete_event(event)
-            middle.site_admin_connector.delete_event(event_middle)
-            last.site_admin_connector.delete_event(event_last)
-            source.site_admin_connector.update_server({'push': False}, source.synchronisations[middle.name].id)
-            middle.site_admin_connector.update_server({'push': False}, middle.synchronisations[last.name].id)
+            middle.site_admin_connector.delete_event(event)
+            last.site_admin_connector.delete_event(event)
 
     def test_complex_event_pull(self):
         '''Test pull'''
         event = self.create_complex_event()
+        source, middle, last = self.lease_instances(3)
         try:
-            source = self.misp_instances.instances[0]
-            middle = self.misp_instances.instances[1]
-            last = self.misp_instances.instances[2]
 
             event = source.org_admin_connector.add_event(event)
             source.org_admin_connector.publish(event)
             middle.site_admin_connector.server_pull(middle.synchronisations[source.name])
-            time.sleep(15)
+            event_middle = middle.wait_for_event(middle.user_connector, event, attributes=3, objects=1)
             last.site_admin_connector.server_pull(last.synchronisations[middle.name])
-            time.sleep(15)
-            event_middle = middle.user_connector.get_event(event.uuid)
-            event_last = last.user_connector.get_event(event.uuid)
+            event_last = last.wait_for_event(last.user_connector, event, attributes=2, objects=1)
             self.assertEqual(len(event_middle.attributes), 3)  # attribute 2, 3 and 4
             self.assertEqual(len(event_middle.objects[0].attributes), 1)  # attribute 2
             self.assertEqual(len(event_last.attributes), 2)  # attribute 3, 4
@@ -209,21 +242,19 @@ class TestSync(unittest.TestCase):
             self.assertEqual(len(event_middle_as_site_admin.objects[0].attributes), 1)  # attribute 2
         finally:
             source.org_admin_connector.delete_event(event)
-            middle.site_admin_connector.delete_event(event_middle)
-            last.site_admin_connector.delete_event(event_last)
+            middle.site_admin_connector.delete_event(event)
+            last.site_admin_connector.delete_event(event)
 
     def test_sharing_group(self):
         '''Test Sharing Group'''
         event = self.create_complex_event()
+        source, middle, last = self.lease_instances(3)
         try:
-            source = self.misp_instances.instances[0]
-            middle = self.misp_instances.instances[1]
-            last = self.misp_instances.instances[2]
-            source.site_admin_connector.update_server({'push': True}, source.synchronisations[middle.name].id)
-            middle.site_admin_connector.update_server({'push': True}, middle.synchronisations[last.name].id)  # Enable automatic push to 3rd instance
+            self.enable_push(source, middle)
+            self.enable_push(middle, last)  # Enable automatic push to 3rd instance
 
             sg = MISPSharingGroup()
-            sg.name = 'Testcases SG'
+            sg.name = f'Testcases SG - {self.namespace}'
             sg.releasability = 'Testing'
             sharing_group = source.site_admin_connector.add_sharing_group(sg)
             source.site_admin_connector.add_org_to_sharing_group(sharing_group, middle.host_org.uuid)
@@ -236,15 +267,14 @@ class TestSync(unittest.TestCase):
 
             event = source.org_admin_connector.add_event(event)
             source.org_admin_connector.publish(event)
-            time.sleep(60)
 
-            event_middle = middle.user_connector.get_event(event)
+            event_middle = middle.wait_for_event(middle.user_connector, event, attributes=2, objects=1)
             self.assertTrue(isinstance(event_middle, MISPEvent), event_middle)
             self.assertEqual(len(event_middle.attributes), 2, event_middle)
             self.assertEqual(len(event_middle.objects), 1, event_middle)
             self.assertEqual(len(event_middle.objects[0].attributes), 1, event_middle)
 
-            event_last = last.user_connector.get_event(event)
+            event_last = last.wait_for_event(last.user_connector, event, attributes=1)
             self.assertTrue(isinstance(event_last, MISPEvent), event_last)
             self.assertEqual(len(event_last.attributes), 1)
             # Test if event is properly sanitized
@@ -265,5 +295,3 @@ class TestSync(unittest.TestCase):
             last.site_admin_connector.delete_event(event)
             source.site_admin_connector.delete_sharing_group(sharing_group.id)
             middle.site_admin_connector.delete_sharing_group(sharing_group.id)
-            source.site_admin_connector.update_server({'push': False}, source.synchronisations[middle.name].id)
-            middle.site_admin_connector.update_server({'push': False}, middle.synchronisations[last.name].id)
@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import json
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+from typing import Dict, Iterator, List, NamedTuple
+
+
+class Span(NamedTuple):
+    phase: str
+    instance: str
+    start: float
+    end: float
+    args: dict
+
+    @property
+    def duration(self) -> float:
+        return self.end - self.start
+
+
+class Tracer():
+    '''Time spent in each phase of each instance, recorded from all the threads.
+    The trace can be loaded in chrome://tracing or https://ui.perfetto.dev (one row per instance).'''
+
+    def __init__(self):
+        self.spans: List[Span] = []
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def span(self, phase: str, instance: str='', **args) -> Iterator[None]:
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add(phase, instance, start, time.time(), **args)
+
+    def add(self, phase: str, instance: str, start: float, end: float, **args):
+        '''Span measured by something else (for example the commands run in a container)'''
+        with self._lock:
+            self.spans.append(Span(phase, instance, start, end, args))
+
+    def chrome_trace(self) -> dict:
+        rows: Dict[str, int] = {}
+        events: List[dict] = []
+        for span in sorted(self.spans, key=lambda span: span.start):
+            row = rows.setdefault(span.instance or 'global', len(rows))
+            events.append({'name': span.phase, 'cat': span.instance or 'global', 'ph': 'X', 'pid': 0, 'tid': row,
+                           'ts': int(span.start * 1e6), 'dur': int(span.duration * 1e6), 'args': span.args})
+        for name, row in rows.items():
+            events.append({'name': 'thread_name', 'ph': 'M', 'pid': 0, 'tid': row, 'args': {'name': name}})
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def dump(self, trace_file: Path):
+        trace_file.parent.mkdir(parents=True, exist_ok=True)
+        with trace_file.open('w') as f:
+            json.dump(self.chrome_trace(), f)
+
+    def summary(self, top: int=10) -> str:
+        '''Total time per phase (all the instances together), and the slowest spans'''
+        per_phase: Dict[str, List[float]] = {}
+        for span in self.spans:
+            per_phase.setdefault(span.phase, []).append(span.duration)
+        width = max((len(phase) for phase in per_phase), default=0)
+        lines = ['Time per phase (total / count / max):']
+        for phase, durations in sorted(per_phase.items(), key=lambda item: sum(item[1]), reverse=True):
+            lines.append(f'    {phase.ljust(width)}  {sum(durations):8.1f}s  {len(durations):4}  {max(durations):7.1f}s')
+        lines.append(f'Slowest {top}:')
+        for span in sorted(self.spans, key=lambda span: span.duration, reverse=True)[:top]:
+            lines.append(f'    {span.duration:7.1f}s  {span.phase} {span.instance}')
+        return '\n'.join(lines)
+
+
+# Shared by all the modules of one run
+tracer = Tracer()
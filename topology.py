@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import json
+from pathlib import Path
+
+from typing import List, NamedTuple, Optional
+
+
+class SyncLink(NamedTuple):
+    '''The source instance gets a server entry pointing to the destination instance
+    (and the destination a sync user for the organisation of the source).'''
+    source: str
+    dest: str
+    push: bool = False
+    pull: bool = True
+
+
+def _both_ways(a: str, b: str) -> List[SyncLink]:
+    return [SyncLink(a, b), SyncLink(b, a)]
+
+
+def star(central: str, clients: List[str]) -> List[SyncLink]:
+    '''All the clients synchronize with the central node'''
+    return [SyncLink(client, central) for client in clients]
+
+
+def full_mesh(central: str, clients: List[str]) -> List[SyncLink]:
+    '''Star, and all the clients synchronize with each other'''
+    return star(central, clients) + [SyncLink(source, dest) for dest in clients for source in clients if source != dest]
+
+
+def chain(central: str, clients: List[str]) -> List[SyncLink]:
+    '''central <-> client 1 <-> client 2 <-> ... <-> client N'''
+    nodes = [central] + clients
+    links: List[SyncLink] = []
+    for a, b in zip(nodes, nodes[1:]):
+        links += _both_ways(a, b)
+    return links
+
+
+def ring(central: str, clients: List[str]) -> List[SyncLink]:
+    '''Chain, with the last client connected to the central node'''
+    links = chain(central, clients)
+    if len(clients) > 1:
+        links += _both_ways(clients[-1], central)
+    return links
+
+
+def tree(central: str, clients: List[str], fanout: int=2) -> List[SyncLink]:
+    '''The central node is the root, each node has (at most) *fanout* children'''
+    nodes = [central] + clients
+    links: List[SyncLink] = []
+    for i, node in enumerate(nodes[1:], start=1):
+        links += _both_ways(node, nodes[(i - 1) // fanout])
+    return links
+
+
+def from_edges_file(edges_file: Path) -> List[SyncLink]:
+    '''JSON file: [{"source": "misp-1", "dest": "misp-central", "push": false, "pull": true}, ...]'''
+    with edges_file.open() as f:
+        edges = json.load(f)
+    return [SyncLink(edge['source'], edge['dest'], edge.get('push', False), edge.get('pull', True)) for edge in edges]
+
+
+topologies = {'star': star, 'full_mesh': full_mesh, 'chain': chain, 'ring': ring, 'tree': tree}
+
+
+def sync_links(topology: str, central: str, clients: List[str], edges_file: Optional[Path]=None,
+               fanout: int=2) -> List[SyncLink]:
+    if edges_file:
+        links = from_edges_file(edges_file)
+    elif topology == 'tree':
+        links = tree(central, clients, fanout)
+    elif topology in topologies:
+        links = topologies[topology](central, clients)
+    else:
+        raise Exception(f'Unknown topology {topology}, must be one of {", ".join(topologies)}')
+
+    known = set([central] + clients)
+    for link in links:
+        if link.source not in known or link.dest not in known:
+            raise Exception(f'Invalid link {link}: unknown instance (known: {", ".join(sorted(known))})')
+        if link.source == link.dest:
+            raise Exception(f'Invalid link {link}: an instance cannot synchronize with itself')
+    return links